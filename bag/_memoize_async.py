@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''Support for coroutine functions in bag.memoize, in a module of its own
+    because ``async def`` is a syntax error before Python 3.5.
+    '''
+
+import asyncio
+from functools import wraps
+from weakref import WeakKeyDictionary
+
+
+def async_wrapper(fn, cache, keymaker, debug):
+    '''Memoizes the *results* of a coroutine function. The wrapper is a
+        coroutine function as well. On a miss it awaits the (shielded)
+        task that is computing the value, which every concurrent caller
+        of the same key shares. Tasks are only shared within an event
+        loop; each loop (e.g. in another thread) computes its own.
+        '''
+    running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+    pending_by_loop = WeakKeyDictionary()
+
+    @wraps(fn)
+    async def wrapper(*a, **kw):
+        key = keymaker(*a, **kw)
+        try:
+            with cache.lock:  # a sweeper thread may be using the cache
+                value = cache[key]
+        except KeyError:
+            pass
+        else:
+            if debug:
+                print('Hit cache of {0}(). Value:\n  {1}'.format(
+                    fn.__name__, key))
+            return value
+        pending = pending_by_loop.setdefault(running_loop(), {})
+        task = pending.get(key)
+        if task is None:
+            task = pending[key] = asyncio.ensure_future(fn(*a, **kw))
+
+            def store(task):
+                del pending[key]
+                if not task.cancelled() and task.exception() is None:
+                    with cache.lock:
+                        cache[key] = task.result()
+            task.add_done_callback(store)
+        # A caller that gets cancelled must not cancel the shared task
+        return await asyncio.shield(task)
+    return wrapper
@@ -22,11 +22,16 @@ def is_valid_image(pth):
     return True
 
 
-def corrupt_images(directory='.', files='*.jpg'):
+def corrupt_images(directory='.', files='*.jpg', exclude=(),
+                   recursive=False):
     '''Generator that, given a ``directory``, goes through all files that
         pass through the filter ``files``, reads them onto Pillow and
         yields each corrupt image path.
 
+        ``files`` and ``exclude`` can be glob patterns or sequences of them;
+        with ``recursive=True`` subdirectories are also scanned.
+        See bag.file_scanner.scan_files().
+
         Example usage::
 
             target = Path('./images/corrupt/')
@@ -35,8 +40,7 @@ def corrupt_images(directory='.', files='*.jpg'):
                 # Do something with *img*, which is a Path object:
                 img.rename(target / img.name)  # move it
         '''
-    from pathlib import Path
-    directory = Path(directory)
-    for p in directory.glob(files):
+    from .file_scanner import scan_files
+    for p, stat in scan_files(directory, files, exclude, recursive):
         if not is_valid_image(p):
             yield p
@@ -4,19 +4,110 @@
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from hashlib import sha1
+from struct import Struct
+from threading import local
+import errno
+import hashlib
+import os
 from nine import str
 
+# inode, size and modification time (in nanoseconds) of a file
+signature = Struct('<QQQ')
+_missing = object()
+_buffers = local()  # one reusable read buffer per thread
+
+
+def new_hash(algorithm='sha1', digest_size=None, data=b''):
+    '''Returns a hashlib object. ``algorithm`` may be any name known to
+        hashlib. ``digest_size`` (in bytes) is only accepted by "blake2b"
+        and "blake2s". Which algorithm is fastest depends on the CPU
+        (some have SHA instructions); run this module to compare them.
+        '''
+    if digest_size:
+        return hashlib.new(algorithm, data, digest_size=digest_size)
+    return hashlib.new(algorithm, data)
+
+
+def algorithm_name(algorithm='sha1', digest_size=None):
+    '''Returns the name under which stores record the algorithm,
+        such as "sha1" or "blake2b-16".
+        '''
+    algorithm = algorithm.lower()
+    return '{0}-{1}'.format(algorithm, digest_size) if digest_size \
+        else algorithm
+
 
 class GdbmStorageStrategy(object):
-    '''Stores file hashes and file paths in a GNU DBM file.'''
+    '''Stores file hashes and file paths in a GNU DBM file.
+
+        With ``incremental=True``, a second file (named after the first,
+        plus ".stats") remembers the stat signature and hash of each
+        path, so unchanged files need not be read again.
 
-    def __init__(self, path='./file_hashes.gdbm', mode='c', sync='s'):
+        The name of the hash algorithm is kept in a third file, with an
+        ".algorithm" suffix, as FileIdManager does. A ".generation" file
+        counts the keys ever added, so a saved BloomFilter can tell
+        whether it is stale.
+        '''
+
+    def __init__(self, path='./file_hashes.gdbm', mode='c', sync='s',
+                 incremental=False):
         from dbm.gnu import open
+        self.path = path
         self.d = open(path, mode + sync)
+        self.stats = open(path + '.stats', mode + sync) if incremental \
+            else None
+        legacy = self.d.get(self.legacy_algorithm_key)
+        if legacy is not None and mode != 'r':
+            # Move the record out of the hashes, where older versions kept it
+            self.algorithm = legacy.decode('ascii')
+            del self.d[self.legacy_algorithm_key]
+        self.generation = self._saved_generation = self._read_generation()
+
+    def _read_generation(self):
+        try:
+            with open(self.path + '.generation') as stream:
+                return int(stream.read())
+        except (IOError, OSError, ValueError):
+            return 0
+
+    def _save_generation(self):
+        with open(self.path + '.generation', 'w') as stream:
+            stream.write(str(self.generation))
+        self._saved_generation = self.generation
+
+    def touch(self):
+        '''Counts a key added to ``d``. The count is saved right away the
+            first time (so it changes on disk even if the process crashes)
+            and then on close().
+            '''
+        self.generation += 1
+        if self.generation == self._saved_generation + 1:
+            self._save_generation()
+
+    legacy_algorithm_key = b'\0algorithm'
+
+    @property
+    def algorithm(self):
+        '''The name of the hash algorithm used in this store, or None.'''
+        try:
+            with open(self.path + '.algorithm') as stream:
+                return stream.read().strip()
+        except (IOError, OSError):
+            value = self.d.get(self.legacy_algorithm_key)
+            return None if value is None else value.decode('ascii')
+
+    @algorithm.setter
+    def algorithm(self, name):
+        with open(self.path + '.algorithm', 'w') as stream:
+            stream.write(name)
 
     def close(self):
         self.d.sync()
+        if self.stats is not None:
+            self.stats.sync()
+        if self.generation != self._saved_generation:
+            self._save_generation()
 
 
 class TransientStrategy(object):
@@ -24,11 +115,201 @@ class TransientStrategy(object):
 
     def __init__(self):
         self.d = {}
+        self.stats = {}
+        self.algorithm = None
 
     def close(self):
         pass
 
 
+class _SqliteMapping(object):
+    '''Dictionary-like access to a table of 2 columns, for
+        SqliteStorageStrategy. Writes are committed in batches.
+        '''
+
+    def __init__(self, store, table, key_column, value_column):
+        self.store = store
+        self.select = 'SELECT {2} FROM {0} WHERE {1}=?'.format(
+            table, key_column, value_column)
+        self.insert = 'INSERT OR REPLACE INTO {0} ({1}, {2}) ' \
+            'VALUES (?, ?)'.format(table, key_column, value_column)
+        self.delete = 'DELETE FROM {0} WHERE {1}=?'.format(table, key_column)
+        self.all = 'SELECT {1}, {2} FROM {0}'.format(
+            table, key_column, value_column)
+        self.count = 'SELECT COUNT(*) FROM {0}'.format(table)
+
+    def get(self, key, default=None):
+        row = self.store.connection.execute(self.select, (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store.connection.execute(self.insert, (key, value))
+        self.store.wrote()
+
+    def __delitem__(self, key):
+        if self.store.connection.execute(self.delete, (key,)).rowcount == 0:
+            raise KeyError(key)
+        self.store.wrote()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return self.store.connection.execute(self.count).fetchone()[0]
+
+    def items(self):
+        return self.store.connection.execute(self.all).fetchall()
+
+    def keys(self):
+        return [row[0] for row in self.items()]
+
+    def values(self):
+        return [row[1] for row in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+class SqliteStorageStrategy(object):
+    '''Stores file hashes and file paths in a SQLite database, which other
+        tools can query: the table "hashes" has the columns "hash"
+        (indexed, as the primary key) and "path" (also indexed, see
+        ``hash_for_path()``). The table "stats" supports incremental scans.
+        A trigger counts every row inserted into "hashes" (whoever
+        inserts it) in the "generation" of the table "meta", so a saved
+        BloomFilter can tell whether it is stale.
+
+        Writes are committed every ``batch_size`` changes (and on
+        ``close()``) in WAL mode, which is much faster than syncing
+        every key.
+        '''
+
+    def __init__(self, path='./file_hashes.sqlite', batch_size=1000):
+        import sqlite3
+        self.batch_size = batch_size
+        self.pending = 0
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes '
+                                '(hash BLOB PRIMARY KEY, path TEXT NOT NULL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS hashes_path '
+                                'ON hashes (path)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS stats '
+                                '(key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                                '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.connection.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('generation', '0')")
+        self.connection.execute(
+            'CREATE TRIGGER IF NOT EXISTS hashes_generation '
+            'AFTER INSERT ON hashes BEGIN UPDATE meta '
+            'SET value = CAST(value AS INTEGER) + 1 '
+            "WHERE key = 'generation'; END")
+        self.connection.commit()
+        self.d = _SqliteMapping(self, 'hashes', 'hash', 'path')
+        self.stats = _SqliteMapping(self, 'stats', 'key', 'value')
+        self.meta = _SqliteMapping(self, 'meta', 'key', 'value')
+
+    @property
+    def algorithm(self):
+        '''The name of the hash algorithm used in this store, or None.'''
+        return self.meta.get('algorithm')
+
+    @algorithm.setter
+    def algorithm(self, name):
+        self.meta['algorithm'] = name
+
+    @property
+    def generation(self):
+        '''How many rows were ever inserted into the "hashes" table.'''
+        return int(self.meta.get('generation', 0))
+
+    def wrote(self):
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def hash_for_path(self, path):
+        '''Reverse lookup: returns the hash stored for ``path``, or None.'''
+        row = self.connection.execute(
+            'SELECT hash FROM hashes WHERE path=?', (str(path),)).fetchone()
+        return None if row is None else row[0]
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class BloomFilter(object):
+    '''A set of bytes keys that answers "definitely not present" or
+        "possibly present" from a compact bit array. Up to ``capacity`` keys,
+        the probability of a false "possibly present" is ``error_rate``.
+        Keys cannot be removed.
+        '''
+    header = Struct('<8sQQQ')  # magic, bits, hashes, store generation
+    magic = b'bagbloom'
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        from math import ceil, log
+        self.bits = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / capacity * log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+
+    def _indexes(self, key):
+        h1, h2 = Struct('<QQ').unpack(
+            hashlib.blake2b(key, digest_size=16).digest())
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for index in self._indexes(key):
+            self.array[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, key):
+        return all(self.array[index >> 3] & (1 << (index & 7))
+                   for index in self._indexes(key))
+
+    def save(self, path, generation=0):
+        '''Writes the filter to ``path``. ``generation`` is a counter that
+            the store increments whenever a key is added to it, which
+            load() uses to detect a stale file.
+            '''
+        with open(path, 'wb') as stream:
+            stream.write(self.header.pack(
+                self.magic, self.bits, self.hashes, generation))
+            stream.write(self.array)
+
+    def load(self, path, generation=0):
+        '''Reads the filter from ``path``. Returns False (and reads
+            nothing) if the file is missing, was made with other settings,
+            or was saved at another ``generation`` of the store.
+            '''
+        try:
+            with open(path, 'rb') as stream:
+                header = stream.read(self.header.size)
+                if header != self.header.pack(
+                        self.magic, self.bits, self.hashes, generation):
+                    return False
+                array = bytearray(stream.read())
+        except (IOError, OSError):
+            return False
+        if len(array) != len(self.array):
+            return False
+        self.array = array
+        return True
+
+
 class FileExistenceManager(object):
     '''Manages a persistent dictionary of 'file IDs' (hashcodes for
         file contents). User code can:
@@ -41,34 +322,233 @@ class FileExistenceManager(object):
         file names are irrelevant.
         '''
 
-    def __init__(self, store, consider_bytes=4096):
+    chunk_size = 1024 * 1024  # for reading entire files
+
+    def __init__(self, store, consider_bytes=4096, algorithm='sha1',
+                 digest_size=None, bloom_error_rate=None,
+                 bloom_capacity=1000000):
         '''If ``consider_bytes`` is a truish integer, configures the system
         to ignore the remainder of each file. ``store`` must be a storage
         strategy instance.
+
+        ``algorithm`` and ``digest_size`` choose the hash function
+        (see new_hash()). The store records it, and a store that contains
+        hashes made by another algorithm raises ValueError.
+
+        Pass a ``bloom_error_rate`` (such as 0.001) to put a BloomFilter in
+        front of the store: hashes that are definitely new are then
+        recognized in memory, and only possible hits reach the store.
+        The filter is saved next to the store (with a ".bloom" suffix)
+        when closing and loaded when opening, unless the ``generation``
+        of the store shows that keys were added meanwhile; then it is
+        rebuilt from the store, as it always is for stores that have no
+        ``generation``. Size ``bloom_capacity`` for the number of files
+        you expect, or the error rate degrades.
         '''
         self.db = store
         self.consider_bytes = consider_bytes
+        self.algorithm = algorithm
+        self.digest_size = digest_size
+        name = algorithm_name(algorithm, digest_size)
+        recorded = getattr(store, 'algorithm', None)
+        if recorded is None and len(store.d):
+            recorded = 'sha1'  # stores older than this setting
+        if recorded is None:
+            store.algorithm = name
+        elif recorded != name:
+            raise ValueError(
+                'The store contains {0} hashes, not {1}.'.format(
+                    recorded, name))
+        self.bloom = None
+        self.inserts = 0  # keys added to the store by this object
+        if bloom_error_rate:
+            self._open_bloom(bloom_capacity, bloom_error_rate)
+
+    @property
+    def bloom_path(self):
+        path = getattr(self.db, 'path', None)
+        return None if path is None else path + '.bloom'
+
+    def _open_bloom(self, capacity, error_rate):
+        self.bloom = BloomFilter(capacity, error_rate)
+        path = self.bloom_path
+        self.bloom_generation = getattr(self.db, 'generation', None)
+        if path is None or self.bloom_generation is None or \
+                not self.bloom.load(path, self.bloom_generation):
+            for key in self.db.d.keys():  # build it from the store
+                self.bloom.add(key)
 
     def close(self):
+        if self.bloom is not None and self.bloom_path is not None and \
+                self.bloom_generation is not None:
+            generation = self.db.generation
+            # Save the filter only if no one else added keys meanwhile
+            if generation == self.bloom_generation + self.inserts:
+                self.bloom.save(self.bloom_path, generation)
         self.db.close()
 
+    def __getstate__(self):
+        '''The store and the Bloom filter are left behind when this object
+            is pickled, so a process pool can call hash_path().
+            '''
+        state = self.__dict__.copy()
+        state['db'] = state['bloom'] = None
+        return state
+
     def _calculate_hash(self, byts):
-        return sha1(byts).digest()  # hexdigest()
+        return new_hash(self.algorithm, self.digest_size, byts).digest()
 
-    def _get_file_hash(self, f):
+    def _get_file_hash(self, f, consider_bytes=None):
         '''Gets a file object, reads a number of bytes from it
-        and returns a hash.
+        (by default, ``self.consider_bytes``) and returns a hash.
         '''
-        if self.consider_bytes:
-            content = f.read(self.consider_bytes)
-        else:
-            content = f.read()  # the entire contents of the file
-        return self._calculate_hash(content)
+        if consider_bytes is None:
+            consider_bytes = self.consider_bytes
+        if consider_bytes:
+            return self._calculate_hash(f.read(consider_bytes))
+        # Hash the entire contents of the file in chunks, so memory use
+        # stays constant however large the file is.
+        h = new_hash(self.algorithm, self.digest_size)
+        buffer = getattr(_buffers, 'buffer', None)
+        if buffer is None or len(buffer) != self.chunk_size:
+            buffer = _buffers.buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        readinto = getattr(f, 'readinto', None)
+        while True:
+            if readinto is None:
+                chunk = f.read(self.chunk_size)
+                size = len(chunk)
+            else:
+                size = readinto(buffer)
+                chunk = view[:size]
+            if not size:
+                return h.digest()
+            h.update(chunk)
+
+    def _stats_key(self, path, consider_bytes):
+        if consider_bytes is None:
+            consider_bytes = self.consider_bytes
+        return '{0}\0{1}'.format(os.path.abspath(str(path)),
+                                 consider_bytes or 0).encode('utf-8')
+
+    @staticmethod
+    def _signature(stat):
+        mtime = getattr(stat, 'st_mtime_ns', None) or \
+            int(stat.st_mtime * 1e9)
+        return signature.pack(stat.st_ino, stat.st_size, mtime)
+
+    def known_hash(self, path, consider_bytes=None, stat=None):
+        '''Returns the hash remembered for the file at ``path`` if its
+            inode, size and modification time are still those in ``stat``
+            (by default, obtained now); otherwise returns None.
+            Always None if the store has no ``stats`` mapping.
+            '''
+        stats = getattr(self.db, 'stats', None)
+        if stats is None:
+            return None
+        record = stats.get(self._stats_key(path, consider_bytes))
+        if record is None:
+            return None
+        if stat is None:
+            stat = os.stat(str(path))
+        if record[:signature.size] == self._signature(stat):
+            return record[signature.size:]
+
+    def remember_hash(self, path, file_hash, stat, consider_bytes=None):
+        '''Stores in the ``stats`` mapping of the store the hash of the file
+            at ``path``, along with its ``stat`` signature from before it
+            was read. If the file used to have another hash, the old
+            entry for it is removed from the store.
+            '''
+        stats = getattr(self.db, 'stats', None)
+        if stats is None:
+            return
+        key = self._stats_key(path, consider_bytes)
+        old = stats.get(key)
+        if old is not None and old[signature.size:] != file_hash:
+            self._forget_hash(old[signature.size:], path, consider_bytes)
+        stats[key] = self._signature(stat) + file_hash
+
+    def _forget_hash(self, file_hash, path, consider_bytes):
+        '''Removes the store entry for ``file_hash`` if it points to
+            ``path`` and was computed with this manager's settings.
+            '''
+        if consider_bytes is None:
+            consider_bytes = self.consider_bytes
+        if (consider_bytes or 0) != (self.consider_bytes or 0):
+            return
+        value = self._hash_exists(file_hash)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        if value == os.path.abspath(str(path)):
+            del self.db.d[file_hash]
+
+    def forget_missing(self, seen=()):
+        '''Removes from the store the entries of files that no longer
+            exist. Paths in ``seen`` are known to exist.
+            Returns how many files were forgotten.
+            '''
+        stats = getattr(self.db, 'stats', None)
+        if stats is None:
+            return 0
+        forgotten = set()
+        for key in list(stats.keys()):
+            path, consider_bytes = key.decode('utf-8').rsplit('\0', 1)
+            if path in seen or os.path.exists(path):
+                continue
+            self._forget_hash(stats[key][signature.size:], path,
+                              int(consider_bytes))
+            del stats[key]
+            forgotten.add(path)
+        return len(forgotten)
+
+    def forget_path(self, path):
+        '''Removes from the store the entry of the file at ``path``, which
+            has been deleted. Needs the ``stats`` mapping of the store to
+            find its hash. Returns the hash forgotten, or None.
+            '''
+        stats = getattr(self.db, 'stats', None)
+        if stats is None:
+            return None
+        key = self._stats_key(path, None)
+        record = stats.get(key)
+        if record is None:
+            return None
+        file_hash = record[signature.size:]
+        self._forget_hash(file_hash, path, None)
+        del stats[key]
+        return file_hash
+
+    def check_hash(self, file_hash, path, replace_missing=False):
+        '''Stores ``file_hash`` for ``path`` unless another file already
+            has it, in which case the path of that file is returned.
+            With ``replace_missing``, an entry pointing to a file that no
+            longer exists is replaced instead.
+            Paths are stored absolute, so the store does not depend on the
+            current directory.
+            '''
+        path = os.path.abspath(str(path))
+        existing = self._try_add_hash(file_hash, path)
+        if isinstance(existing, bytes):
+            existing = existing.decode('utf-8')
+        if existing and replace_missing and not os.path.exists(existing):
+            self._add_or_replace_hash(file_hash, path)
+        elif existing and existing != path:
+            return existing
+
+    def hash_path(self, path, consider_bytes=None):
+        '''Opens the file at ``path`` and returns its hash.
+            Does not touch the store, so it can run in other threads.
+            '''
+        with open(str(path), 'rb') as stream:
+            return self._get_file_hash(stream, consider_bytes)
 
     def _hash_exists(self, byts):
         '''Looks up the file dictionary. Returns None if the provided hash
         does not yet exist, or the dictionary value if it does exist.
         '''
+        if self.bloom is not None and byts not in self.bloom:
+            return None
         return self.db.d.get(byts)
 
     def file_exists(self, f):
@@ -80,6 +560,12 @@ class FileExistenceManager(object):
 
     def _add_or_replace_hash(self, byts, value):
         self.db.d[byts] = value
+        touch = getattr(self.db, 'touch', None)
+        if touch is not None:
+            touch()
+        self.inserts += 1
+        if self.bloom is not None:
+            self.bloom.add(byts)
 
     def add_or_replace_file(self, f, value):
         '''Puts the hash for file ``f`` (associated with ``value``) in the
@@ -94,7 +580,9 @@ class FileExistenceManager(object):
         '''If the hash for file ``f`` already exists, just returns the
         associated value. If not, adds the hash with the provided ``value``.
         '''
-        file_hash = self._get_file_hash(f)
+        return self._try_add_hash(self._get_file_hash(f), value)
+
+    def _try_add_hash(self, file_hash, value):
         val = self._hash_exists(file_hash)
         if val:
             return val
@@ -102,10 +590,121 @@ class FileExistenceManager(object):
             self._add_or_replace_hash(file_hash, value)
 
 
-def find_dups(directory='.', files='*.jpg', callbacks=[]):
+class _Done(object):
+    '''Looks like a finished future.'''
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        return self.value
+
+
+def _ordered_map(executor, function, iterable, window, shortcut=None):
+    '''Like ``executor.map()``, but submits at most ``window`` tasks ahead of
+        the results consumed, instead of all of them at once.
+        Generates (item, result) tuples in the order of ``iterable``.
+        If ``shortcut(item)`` returns something other than None, that is
+        the result and no task is submitted.
+        '''
+    from collections import deque
+    futures = deque()
+    for item in iterable:
+        value = None if shortcut is None else shortcut(item)
+        futures.append((item, executor.submit(function, item)
+                        if value is None else _Done(value)))
+        if len(futures) >= window:
+            item, future = futures.popleft()
+            yield item, future.result()
+    while futures:
+        item, future = futures.popleft()
+        yield item, future.result()
+
+
+def _group_by_hash(pairs):
+    '''Given (path, hash) tuples, returns a list of (hash, paths)
+        for the hashes shared by 2 or more paths,
+        in the order the hashes were first seen.
+        '''
+    from collections import OrderedDict
+    groups = OrderedDict()
+    for path, file_hash in pairs:
+        groups.setdefault(file_hash, []).append(path)
+    return [(h, group) for h, group in groups.items() if len(group) > 1]
+
+
+def group_identical(entries, hash_many, prefix_bytes=4096):
+    '''Generator of (hash, paths) tuples for the groups of files with
+        identical content among ``entries``, which are (path, stat)
+        tuples such as those from scan_files(). The groups are found in
+        stages that read as little as possible:
+
+        1. Files are grouped by size. A file of unique size is never read.
+        2. Within each size collision, the first ``prefix_bytes``
+           are hashed.
+        3. Within each prefix collision, the entire files are hashed.
+
+        ``hash_many(paths, consider_bytes)`` must return an iterable of
+        (path, hash) tuples, in order, reading only ``consider_bytes``
+        from each file (or the entire file if 0). The yielded hash is always
+        that of the entire contents, and paths keep their original order.
+        '''
+    from collections import OrderedDict
+    by_size = OrderedDict()
+    for path, stat in entries:
+        by_size.setdefault(stat.st_size, []).append(path)
+    for size, same_size in by_size.items():
+        if len(same_size) < 2:
+            continue
+        if size <= prefix_bytes:  # The prefix is the entire content.
+            for group in _group_by_hash(hash_many(same_size, 0)):
+                yield group
+            continue
+        for prefix_hash, same_prefix in _group_by_hash(
+                hash_many(same_size, prefix_bytes)):
+            for group in _group_by_hash(hash_many(same_prefix, 0)):
+                yield group
+
+
+def find_dups(directory='.', files='*.jpg', callbacks=[], workers=None,
+              processes=False, store=None, consider_bytes=4096,
+              staged=False, incremental=False, algorithm='sha1',
+              digest_size=None, exclude=(), recursive=False):
     '''Given a ``directory``, goes through all files that pass through the
         filter ``files``, and for each one that is a duplicate, calls a number
-        of ``callbacks``. Returns a dictionary containing the duplicates found.
+        of ``callbacks``. Returns a dictionary containing the duplicates found,
+        pointing to the files they duplicate; all paths are absolute.
+
+        ``files`` and ``exclude`` are glob patterns (or sequences of them)
+        for file names (a ``files`` pattern such as ``'**/*.jpg'`` is
+        matched against paths instead); with ``recursive=True``,
+        subdirectories are scanned too (you probably want
+        ``exclude='dups'`` then).
+        See bag.file_scanner.scan_files(). Files are checked as they are
+        found, except in ``staged`` mode, which must see them all first.
+
+        By default only the first ``consider_bytes`` of each file are
+        compared, which is fast but can mistake files with identical
+        headers for duplicates. With ``staged=True`` the results are exact
+        and most files are not even read: see group_identical(). In this
+        mode the store receives hashes of entire contents, and only for
+        files that have the same size as another one.
+
+        With ``incremental=True``, the store remembers the inode, size and
+        modification time of each file along with its hash, so a rescan
+        only reads new or modified files, and forgets files that have
+        disappeared. The store must support it (it needs a ``stats``
+        mapping) and be reused between runs.
+
+        With a number of ``workers``, files are read and hashed by a pool of
+        threads (or of processes, if ``processes`` is true), which helps
+        when a single core or I/O latency is the bottleneck. Results are
+        still consumed in the order of the files, in this thread, so the
+        store writes and the callbacks happen exactly as without workers.
+
+        ``store`` defaults to a GdbmStorageStrategy in the current directory;
+        ``consider_bytes``, ``algorithm`` and ``digest_size`` are passed on
+        to the FileExistenceManager.
 
         Example usage::
 
@@ -116,19 +715,78 @@ def find_dups(directory='.', files='*.jpg', callbacks=[]):
         ``existing`` and ``dup`` are paths and ``m`` is the
         FileExistenceManager instance.
         '''
+    from functools import partial
     from pathlib import Path
-    store = GdbmStorageStrategy()
-    m = FileExistenceManager(store)
+    from .file_scanner import scan_files
+    if store is None:
+        store = GdbmStorageStrategy(incremental=incremental)
+    m = FileExistenceManager(
+        store, consider_bytes=0 if staged else consider_bytes,
+        algorithm=algorithm, digest_size=digest_size)
     dups = {}
-    for p in Path(directory).glob(files):
-        with open(str(p), 'rb') as stream:
-            existing = m.try_add_file(stream, str(p))
+    seen = set()
+    scanned = {}  # stat results from the directory scan
+    signatures = {}  # stat results of the files being hashed now
+    executor = None
+    if workers:
+        from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+        executor = (ProcessPoolExecutor if processes else ThreadPoolExecutor)(
+            max_workers=workers)
+
+    def known(p, consider_bytes):
+        if not incremental:
+            return None
+        stat = scanned.get(p) or os.stat(str(p))
+        seen.add(os.path.abspath(str(p)))
+        file_hash = m.known_hash(str(p), consider_bytes, stat)
+        if file_hash is None:
+            signatures[p] = stat
+        return file_hash
+
+    def hash_many(paths, consider_bytes=None):
+        function = partial(m.hash_path, consider_bytes=consider_bytes)
+        if executor is None:
+            pairs = ((p, known(p, consider_bytes) or function(p))
+                     for p in paths)
+        else:
+            pairs = _ordered_map(
+                executor, function, paths, 4 * workers,
+                shortcut=partial(known, consider_bytes=consider_bytes))
+        for p, file_hash in pairs:
+            if p in signatures:  # it has just been read
+                m.remember_hash(str(p), file_hash, signatures.pop(p),
+                                consider_bytes)
+            yield p, file_hash
+
+    def check(file_hash, p):
+        existing = m.check_hash(file_hash, p, replace_missing=incremental)
         if existing:
-            existing = existing.decode('utf-8')
-            dups[str(p)] = existing
+            path = os.path.abspath(str(p))  # like existing
+            dups[path] = existing
             for function in callbacks:
-                function(Path(existing), p, m)
-    m.close()
+                function(Path(existing), Path(path), m)
+
+    def scan():
+        for p, stat in scan_files(directory, files, exclude, recursive):
+            scanned[p] = stat
+            yield p, stat
+
+    try:
+        if staged:
+            for file_hash, group in group_identical(
+                    scan(), hash_many, prefix_bytes=consider_bytes or 4096):
+                for p in group:
+                    check(file_hash, p)
+        else:
+            for p, file_hash in hash_many(p for p, stat in scan()):
+                check(file_hash, p)
+                scanned.pop(p, None)
+        if incremental:
+            m.forget_missing(seen)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        m.close()
     return dups
 
 
@@ -169,3 +827,357 @@ class KeepLarger(object):
                 directory.mkdir(parents=True)
             except OSError:
                 pass
+
+
+class LinkDuplicates(object):
+    '''A callback that reclaims disk space by replacing each duplicate with
+        a link to the existing file. ``mode`` can be:
+
+        - "hardlink": both paths become the same file (same inode).
+        - "reflink": the duplicate becomes a copy-on-write clone of the
+          existing file (Linux FICLONE, on btrfs, XFS etc.), so the two
+          stay independent files that share their data blocks.
+        - "auto": reflink where the filesystem supports it, else hardlink.
+
+        Before linking, the files are compared byte by byte, since
+        find_dups may only have compared their beginnings. With
+        ``dry_run=True`` (the default) nothing is changed; the summary
+        tells what would be done. Example::
+
+            linker = LinkDuplicates(mode='auto', dry_run=True)
+            find_dups('photos', callbacks=[linker], staged=True)
+            print(linker.to_json())  # review, then run with dry_run=False
+
+        Bytes are only counted as reclaimed when the duplicate had no
+        other hard links.
+        '''
+    FICLONE = 0x40049409  # from linux/fs.h
+
+    def __init__(self, mode='hardlink', dry_run=True):
+        if mode not in ('hardlink', 'reflink', 'auto'):
+            raise ValueError('Unknown mode: {0}'.format(mode))
+        self.mode = mode
+        self.dry_run = dry_run
+        self.summary = {'mode': mode, 'dry_run': dry_run, 'linked': 0,
+                        'skipped': 0, 'bytes_reclaimed': 0, 'errors': []}
+
+    def __call__(self, existing, dup, m):
+        from filecmp import cmp
+        existing, dup = str(existing), str(dup)
+        try:
+            stat = os.stat(dup)
+            if os.path.samefile(existing, dup) or \
+                    not cmp(existing, dup, shallow=False):
+                self.summary['skipped'] += 1
+                return
+            if not self.dry_run:
+                self.link(existing, dup)
+        except (IOError, OSError) as e:
+            self.summary['errors'].append(
+                {'existing': existing, 'dup': dup, 'error': str(e)})
+            return
+        self.summary['linked'] += 1
+        if stat.st_nlink == 1:
+            self.summary['bytes_reclaimed'] += stat.st_size
+
+    def link(self, existing, dup):
+        '''Replaces ``dup`` with a link to ``existing``. A temporary file
+            is created first and then renamed over ``dup``, so ``dup`` is
+            never missing nor half written.
+            '''
+        temporary = os.path.join(os.path.dirname(dup),
+                                 '.{0}.link'.format(os.path.basename(dup)))
+        if self.mode != 'hardlink':
+            try:
+                self._reflink(existing, dup, temporary)
+            except (IOError, OSError):
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                if self.mode == 'reflink':
+                    raise
+            else:
+                return
+        os.link(existing, temporary)
+        os.rename(temporary, dup)
+
+    def _reflink(self, existing, dup, temporary):
+        try:
+            import fcntl
+        except ImportError:  # not a POSIX platform
+            raise OSError(errno.ENOSYS, 'Reflinks are not supported here.')
+        from shutil import copystat
+        with open(existing, 'rb') as source:
+            with open(temporary, 'wb') as target:
+                fcntl.ioctl(target.fileno(), self.FICLONE, source.fileno())
+        copystat(dup, temporary)
+        os.rename(temporary, dup)
+
+    def to_json(self):
+        from json import dumps
+        return dumps(self.summary, indent=2, sort_keys=True)
+
+
+class DedupIndex(object):
+    '''Keeps the store of a FileExistenceManager current while files come
+        and go, so duplicates are found as they land, without rescanning
+        whole directories. Call ``update(path)`` (or the instance itself)
+        whenever a file appears, changes or disappears; that is the
+        callback signature of the watchers in bag.file_watcher, so the
+        easiest way to use this is the watch() method::
+
+            index = DedupIndex(FileExistenceManager(
+                GdbmStorageStrategy(incremental=True)),
+                callbacks=[print_dups])
+            index.watch('uploads', files='*.jpg').loop()
+
+        New and modified files are hashed (unless the ``stats`` mapping of
+        the store shows they have not changed) and checked; the callbacks
+        receive (existing, dup, m) just like in find_dups(). Deleted files
+        are removed from the store, and if such a file had duplicates,
+        one of them takes its place.
+        Use a store with a ``stats`` mapping, such as
+        ``GdbmStorageStrategy(incremental=True)`` or SqliteStorageStrategy,
+        otherwise the entries of changed or deleted files linger.
+
+        ``dups`` is a dictionary of the duplicates found, pointing to the
+        paths they duplicate.
+        '''
+
+    def __init__(self, manager, callbacks=[]):
+        self.manager = manager
+        self.callbacks = callbacks
+        self.dups = {}
+
+    def update(self, path):
+        '''Brings the store up to date with the file at ``path``.'''
+        from pathlib import Path
+        path = os.path.abspath(str(path))
+        m = self.manager
+        try:
+            stat = os.stat(path)
+            file_hash = m.known_hash(path, None, stat)
+            if file_hash is None:  # The file is new or has changed
+                file_hash = m.hash_path(path)
+                self._forget(path)
+                m.remember_hash(path, file_hash, stat)
+        except (IOError, OSError):  # The file is gone
+            self._forget(path)
+        else:
+            existing = m.check_hash(file_hash, path, replace_missing=True)
+            while existing and self._changed(existing, file_hash):
+                existing = m.check_hash(file_hash, path,
+                                        replace_missing=True)
+            if existing:
+                self.dups[path] = existing
+                for function in self.callbacks:
+                    function(Path(existing), Path(path), m)
+        self._commit()
+
+    __call__ = update
+
+    def _changed(self, existing, file_hash):
+        '''Returns whether the file at ``existing`` no longer has
+            ``file_hash``, because it changed after being stored and its
+            own change has not been handled yet. If so, it is updated now.
+            '''
+        m = self.manager
+        try:
+            if m.known_hash(existing) == file_hash:
+                return False
+            changed = m.hash_path(existing) != file_hash
+        except (IOError, OSError):  # It is gone
+            changed = True
+        if changed:
+            self.update(existing)
+        return changed
+
+    def _forget(self, path):
+        m = self.manager
+        file_hash = m.forget_path(path)
+        self.dups.pop(path, None)
+        heirs = [dup for dup, existing in self.dups.items()
+                 if existing == path]
+        heir = None
+        for dup in heirs:
+            del self.dups[dup]
+            if not os.path.exists(dup):
+                m.forget_path(dup)
+            elif heir is None:
+                heir = dup
+                if file_hash is not None:
+                    m._add_or_replace_hash(file_hash, heir)
+            else:
+                self.dups[dup] = heir
+
+    def _commit(self):
+        commit = getattr(self.manager.db, 'commit', None)
+        if commit is not None:
+            commit()
+
+    def watch(self, directories, files='*', exclude=(), recursive=True,
+              seconds=1.3):
+        '''Indexes the files in ``directories`` now, forgets the entries
+            of files deleted since the store was last used, and returns
+            a bag.file_watcher.DirectoryWatcher that keeps the index
+            current when you call its loop() method.
+            '''
+        from .file_watcher import DirectoryWatcher
+        watcher = DirectoryWatcher(
+            directories, self.update, files=files, exclude=exclude,
+            recursive=recursive, seconds=seconds, initial=True)
+        watcher.iterate()
+        self.manager.forget_missing(
+            set(os.path.abspath(path) for path in watcher.snapshot))
+        self._commit()
+        return watcher
+
+
+def hamming_distance(a, b):
+    '''Returns how many bits differ between the integers ``a`` and ``b``.'''
+    return bin(a ^ b).count('1')
+
+
+def dhash(path, size=8):
+    '''Returns the difference hash of the image at ``path``, an integer of
+        ``size * size`` bits. Unlike a hash of the bytes, it barely changes
+        when the image is re-encoded, resized or slightly edited, so the
+        hamming_distance() between two dHashes measures how similar the
+        images look. Requires Pillow.
+        '''
+    from PIL import Image  # https://pypi.python.org/pypi/Pillow
+    img = Image.open(str(path))
+    try:
+        pixels = list(img.convert('L').resize(
+            (size + 1, size), Image.LANCZOS).getdata())
+    finally:
+        img.close()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            value = (value << 1) | (left > pixels[row * (size + 1) + col + 1])
+    return value
+
+
+class BKTree(object):
+    '''Burkhard-Keller tree of integer hashes under the Hamming distance.
+        search() finds the hashes within a distance of a query without
+        comparing it to all of them: the triangle inequality rules out
+        whole subtrees.
+        '''
+
+    def __init__(self):
+        self.root = None  # Each node is (hash, values, {distance: node})
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, h, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (h, [value], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(h, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = (h, [value], {})
+                return
+            node = child
+
+    def search(self, h, max_distance):
+        '''Returns a list of (distance, value) tuples for the values whose
+            hashes are at most ``max_distance`` from ``h``, closest first.
+            '''
+        found = []
+        pending = [] if self.root is None else [self.root]
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(h, node[0])
+            if distance <= max_distance:
+                found.extend((distance, value) for value in node[1])
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    pending.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+def find_similar_images(directory='.', files=('*.jpg', '*.jpeg', '*.png'),
+                        callbacks=[], max_distance=4, exclude=(),
+                        recursive=False, hash_function=dhash):
+    '''Like find_dups(), but finds images that *look* the same, such as
+        re-encoded or resized copies, by comparing their perceptual hashes.
+        Each image is compared to the closest one seen before it, if their
+        hashes differ by at most ``max_distance`` bits (out of 64).
+        Files that Pillow cannot read are skipped.
+
+        Returns a dictionary of near-duplicate paths to the similar
+        images found before them. The callbacks receive
+        (existing, dup, tree), where ``tree`` is the BKTree.
+        '''
+    from pathlib import Path
+    from .file_scanner import scan_files
+    tree = BKTree()
+    dups = {}
+    for p, stat in scan_files(directory, files, exclude, recursive):
+        try:
+            h = hash_function(p)
+        except (IOError, OSError, ValueError):
+            continue
+        similar = tree.search(h, max_distance)
+        if similar:
+            existing = similar[0][1]
+            dups[str(p)] = existing
+            for function in callbacks:
+                function(Path(existing), p, tree)
+        tree.add(h, str(p))
+    return dups
+
+
+if __name__ == '__main__':
+    from shutil import rmtree
+    from tempfile import mkdtemp
+    from time import time
+    directory = mkdtemp()
+    try:
+        # Benchmark: throughput of hash algorithms on a large file
+        big = os.path.join(directory, 'big.bin')
+        size = 256 * 1024 * 1024
+        with open(big, 'wb') as stream:
+            for i in range(size // (1024 * 1024)):
+                stream.write(os.urandom(1024 * 1024))
+        for algorithm, digest_size in (
+                ('md5', None), ('sha1', None), ('sha256', None),
+                ('blake2b', None), ('blake2b', 16), ('blake2s', None)):
+            m = FileExistenceManager(TransientStrategy(), consider_bytes=0,
+                                     algorithm=algorithm,
+                                     digest_size=digest_size)
+            start = time()
+            m.hash_path(big)
+            print('{0:<12}: {1:7.1f} MB/s'.format(
+                algorithm_name(algorithm, digest_size),
+                size / (1024 * 1024) / (time() - start)))
+        os.remove(big)
+
+        # Benchmark: hashing whole files with more and more workers
+        for i in range(400):
+            with open(os.path.join(directory, '{0}.jpg'.format(i)), 'wb') \
+                    as stream:
+                stream.write(os.urandom(1024 * 1024))
+        counts = [None] + [2 ** i for i in range(
+            (os.cpu_count() or 1).bit_length() + 1)]
+        for workers in counts:
+            for processes in ((False, True) if workers else (False,)):
+                start = time()
+                find_dups(directory, workers=workers, processes=processes,
+                          store=TransientStrategy(), consider_bytes=0)
+                print('workers={0!s:4} processes={1!s:5}: {2:.3f}s'.format(
+                    workers, processes, time() - start))
+    finally:
+        rmtree(directory)
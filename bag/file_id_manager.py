@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os
 import struct
-from hashlib import sha1
 from nine import basestring, str
+from .file_existence_manager import algorithm_name, new_hash
 
 from warnings import warn
 warn('Use bag.file_existence_manager instead of FileIdManager.',
@@ -18,12 +19,44 @@ class FileIdManager(object):
 
     Only file content and length are considered; file names are
     irrelevant.
+
+    The hash function can be changed through ``algorithm`` and
+    ``digest_size`` (see bag.file_existence_manager.new_hash), as long as
+    it produces 20 bytes, e.g. ``algorithm='blake2b', digest_size=20``.
+    The choice is recorded in a ".algorithm" file next to the IDs file,
+    and an IDs file made by another algorithm raises ValueError.
+
+    The first lookup loads all IDs into a set, which is then kept up to
+    date by add_file_id(), so lookups take constant time. The file format
+    is unchanged. IDs appended by other processes are not seen.
     """
     recordlength = 24  # bytes
 
-    def __init__(self, path):
+    def __init__(self, path, algorithm='sha1', digest_size=None):
+        self.algorithm = algorithm
+        self.digest_size = digest_size
+        if new_hash(algorithm, digest_size).digest_size != 20:
+            raise ValueError('FileIdManager needs a 20-byte digest.')
+        self._check_algorithm(path)
         # Open the dictionary file for updates
-        self.f = open(path, b"ab+")
+        self.f = open(path, "ab+")
+        self.known_ids = None  # loaded on the first lookup
+
+    def _check_algorithm(self, path):
+        name = algorithm_name(self.algorithm, self.digest_size)
+        sidecar = path + '.algorithm'
+        if os.path.exists(sidecar):
+            with open(sidecar) as stream:
+                recorded = stream.read().strip()
+        elif os.path.exists(path) and os.path.getsize(path):
+            recorded = 'sha1'  # files older than this setting
+        else:
+            with open(sidecar, 'w') as stream:
+                stream.write(name)
+            return
+        if recorded != name:
+            raise ValueError('The file contains {0} IDs, not {1}.'.format(
+                recorded, name))
 
     def close(self):
         self.f.close()
@@ -37,19 +70,28 @@ class FileIdManager(object):
         if len(content) == 0:
             return b"\0" * self.recordlength
         else:
-            h = sha1(content).digest()          # 20 bytes for the hash
+            h = new_hash(self.algorithm, self.digest_size,
+                         content).digest()  # 20 bytes for the hash
             s = struct.pack("i", len(content))  # 04 bytes for the length
             return s + h                        # 24 bytes total
 
+    def _load_ids(self):
+        known_ids = set()
+        chunk_size = self.recordlength * 4096
+        self.f.seek(0)
+        while True:
+            chunk = self.f.read(chunk_size)
+            if not chunk:
+                break
+            known_ids.update(chunk[i:i + self.recordlength]
+                             for i in range(0, len(chunk), self.recordlength))
+        self.known_ids = known_ids
+
     def is_id_known(self, file_id):
         self.validate_id(file_id)
-        self.f.seek(0)
-        s = self.f.read(self.recordlength)
-        while s != "":
-            if file_id == s:
-                return True
-            s = self.f.read(self.recordlength)
-        return False
+        if self.known_ids is None:
+            self._load_ids()
+        return file_id in self.known_ids
 
     def validate_id(self, file_id):
         length = len(file_id)
@@ -61,6 +103,8 @@ class FileIdManager(object):
         self.f.seek(0, 2)  # move to end of file
         self.f.write(file_id)
         self.f.flush()
+        if self.known_ids is not None:
+            self.known_ids.add(file_id)
 
     def process(self, content, closefile=True):
         """Example implementation (see source code of this method)."""
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+'''Fast directory walking for tools that process many files.'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from contextlib import contextmanager
+from fnmatch import fnmatch
+import os
+from nine import basestring
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    from scandir import scandir
+
+
+@contextmanager
+def listing(directory):
+    '''Like ``with os.scandir(directory) as entries``, which needs
+        Python 3.6, but also works with older versions of scandir().
+        '''
+    entries = scandir(directory)
+    try:
+        yield entries
+    finally:
+        close = getattr(entries, 'close', None)  # Python >= 3.6
+        if close is not None:
+            close()
+
+
+class LazyStat(object):
+    '''Stands for the stat result of an os.DirEntry, but only calls its
+        stat() method (a system call on POSIX, though not on Windows)
+        when an attribute such as ``st_size`` is first read.
+        '''
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def __getattr__(self, name):
+        return getattr(self.entry.stat(), name)  # which caches it
+
+
+def scan_files(directory='.', include='*', exclude=(), recursive=True):
+    '''Generator of (path, stat) tuples for the files in ``directory`` whose
+        names match one of the ``include`` glob patterns and none of the
+        ``exclude`` patterns. Each argument can be a pattern or a
+        sequence of patterns. With ``recursive``, subdirectories are
+        walked too, except those whose names match ``exclude``.
+
+        An ``include`` pattern that contains a path separator, such as
+        ``'**/*.jpg'`` or ``'sub/*.jpg'``, is a pathlib glob pattern
+        relative to ``directory`` instead; it decides by itself how deep
+        to look, regardless of ``recursive``.
+
+        Paths are pathlib.Path objects. The stat results are LazyStat
+        objects, which only call stat() when an attribute is read, so
+        consumers that just need the paths do not pay for it on POSIX.
+        Tuples are generated during the walk, so consumers can start
+        working before it finishes. Example::
+
+            for path, stat in scan_files('photos', include=('*.jpg',
+                                         '*.jpeg'), exclude='dups'):
+                print(path, stat.st_size)
+        '''
+    from pathlib import Path
+    if isinstance(include, basestring):
+        include = (include,)
+    if isinstance(exclude, basestring):
+        exclude = (exclude,)
+    separators = set((os.sep, os.altsep, '/')) - set((None,))
+    globs = [pattern for pattern in include
+             if any(sep in pattern for sep in separators)]
+    names = [pattern for pattern in include if pattern not in globs]
+    found = set()  # only needed when a file may match both kinds
+    if names:
+        for path, stat in _walk(str(directory), names, exclude, recursive):
+            path = Path(path)
+            if globs:
+                found.add(path)
+            yield path, stat
+    for pattern in globs:
+        for path in Path(str(directory)).glob(pattern):
+            parts = path.relative_to(str(directory)).parts
+            if path in found or not path.is_file() or any(
+                    fnmatch(part, excluded)
+                    for part in parts for excluded in exclude):
+                continue
+            found.add(path)
+            yield path, path.stat()
+
+
+def _walk(directory, include, exclude, recursive):
+    pending = [directory]
+    while pending:
+        try:
+            entries = scandir(pending.pop())
+        except OSError:  # e.g. permission denied
+            continue
+        subdirectories = []
+        try:
+            for entry in entries:
+                if any(fnmatch(entry.name, pattern) for pattern in exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        subdirectories.append(entry.path)
+                elif entry.is_file() and any(
+                        fnmatch(entry.name, pattern) for pattern in include):
+                    yield entry.path, LazyStat(entry)
+        finally:
+            close = getattr(entries, 'close', None)  # Python >= 3.6
+            if close is not None:
+                close()
+        pending.extend(reversed(subdirectories))
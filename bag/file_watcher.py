@@ -1,9 +1,30 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+from collections import OrderedDict
+from fnmatch import fnmatch
+from struct import Struct
 from time import sleep
+import errno
 import os
 import sys
+import time
+from nine import basestring
+from .file_scanner import listing
+
+# A clock that does not jump when the system time is adjusted;
+# Python 2 does not have one, so there it falls back to time.time().
+monotonic = getattr(time, 'monotonic', time.time)
+try:
+    from os import fsdecode, fsencode
+except ImportError:  # Python 2
+    def fsencode(path):
+        if isinstance(path, bytes):
+            return path
+        return path.encode(sys.getfilesystemencoding())
+
+    def fsdecode(name):
+        return name.decode(sys.getfilesystemencoding())
 
 
 class PausingLooper(object):
@@ -23,17 +44,254 @@ class PausingLooper(object):
                 sleep(self.pause_duration)
 
 
+class Inotify(object):
+    '''A thin wrapper of the Linux inotify API, through ctypes.
+    The constructor raises OSError where inotify is not available.
+    The file descriptor is non-blocking; wait on it with select() or
+    an event loop, since this object has a fileno() method.
+    '''
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    event = Struct('iIII')  # wd, mask, cookie, len; then the name
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        import ctypes
+        from ctypes.util import find_library
+        try:
+            libc = ctypes.CDLL(find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [
+            ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._get_errno = ctypes.get_errno
+        # IN_CLOEXEC and IN_NONBLOCK have the values of their O_ twins
+        self.fd = inotify_init1(
+            getattr(os, 'O_CLOEXEC', 0o2000000) | os.O_NONBLOCK)  # py2
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self):
+        number = self._get_errno()
+        raise OSError(number, os.strerror(number))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        '''Starts watching *path*; returns the watch descriptor.'''
+        wd = self._add_watch(self.fd, fsencode(path), mask)
+        if wd < 0:
+            self._raise()
+        return wd
+
+    def rm_watch(self, wd):
+        '''Stops using the watch descriptor *wd*.'''
+        if self._rm_watch(self.fd, wd) < 0:
+            self._raise()
+
+    def read(self):
+        '''Returns a list of the pending events, without blocking.
+        Each event is a (wd, mask, cookie, name) tuple.
+        '''
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self.event.unpack_from(
+                    data, offset)
+                offset += self.event.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, cookie, fsdecode(name)))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
 class FileWatcher(PausingLooper):
     '''When you call the loop() method, watches a sequence of *files*
     for alterations and calls a function when any of them changes.
     That *callback* function gets, as an argument, the changed file path.
+
+    On Linux the *backend* is inotify: the directories of the files are
+    watched by the kernel, the callback is called as soon as a file is
+    written, replaced or deleted, and nothing is done while nothing
+    changes (*seconds* is then just how often loop() checks whether it
+    should stop). For a path that is a symlink, the directory of its
+    target is watched too. Elsewhere, or if inotify fails (e.g. when
+    there are too many watches), the files are polled every *seconds*.
+    Pass ``backend='poll'`` to always poll, or ``backend='inotify'``
+    to raise OSError instead of falling back.
+
+    Polling stats every file. For large sets of files where inotify is
+    not an option (such as NFS mounts), ``backend='scandir'`` lists each
+    directory once with os.scandir() instead, and skips directories
+    whose own modification time has not changed. Since writing to a file
+    in place does not touch its directory, every *rescan* checks all
+    directories are listed anyway. When polling, *max_seconds* makes
+    the interval grow by half while nothing changes, up to that limit;
+    it is back to *seconds* after a change.
+
+    With *debounce* (in seconds), changes are batched: the callback is
+    called with a set of changed paths once no more changes have been
+    seen for *debounce* seconds -- or *max_delay* seconds after the
+    first change in the batch, so that a steady stream of changes cannot
+    postpone the callback forever. A ``git checkout`` then causes one
+    rebuild instead of hundreds.
     '''
+    WATCH_MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_ATTRIB |
+                  Inotify.IN_MOVED_TO | Inotify.IN_MOVED_FROM |
+                  Inotify.IN_CREATE | Inotify.IN_DELETE | Inotify.IN_ONLYDIR)
 
-    def __init__(self, files, callback, seconds=1.3):
+    def __init__(self, files, callback, seconds=1.3, backend='auto',
+                 max_seconds=None, rescan=10, debounce=None, max_delay=5):
+        if backend not in ('auto', 'inotify', 'poll', 'scandir'):
+            raise ValueError('Unknown backend: {0}'.format(backend))
         self.callback = callback
-        self.pause_duration = seconds
+        self.pause_duration = self.seconds = seconds
+        self.max_seconds = max_seconds
+        self.rescan = rescan
+        self.checks = 0
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.pending = set()
+        self.first_change = self.last_change = None
         self.mtimes = {}
+        self.directory_mtimes = {}
         self.files = set(self.filter(files))
+        self.directories = {}  # directory: {file name: path}
+        for path in self.files:
+            directory, name = os.path.split(os.path.abspath(path))
+            self.directories.setdefault(directory, {})[name] = path
+        self.inotify = None
+        self.backend = 'poll' if backend == 'auto' else backend
+        if backend in ('auto', 'inotify'):
+            try:
+                self._watch_directories()
+            except OSError:
+                if backend == 'inotify':
+                    raise
+            else:
+                self.backend = 'inotify'
+
+    def _watched_names(self):
+        '''Returns a dictionary {directory: {file name: [paths]}}.
+        A path that is a symlink appears both in its own directory and
+        in that of its target, because inotify reports changes to the
+        target's contents only in the latter.
+        '''
+        directories = {}
+        for path in self.files:
+            for target in (os.path.abspath(path), os.path.realpath(path)):
+                directory, name = os.path.split(target)
+                paths = directories.setdefault(directory, {}) \
+                    .setdefault(name, [])
+                if path not in paths:
+                    paths.append(path)
+        return directories
+
+    def _watch_directories(self):
+        inotify = Inotify()
+        self.watches = {}  # watch descriptor: {file name: [paths]}
+        try:
+            for directory, names in self._watched_names().items():
+                try:
+                    wd = inotify.add_watch(directory, self.WATCH_MASK)
+                except OSError as e:
+                    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                        continue  # Like a file that is not there.
+                    raise
+                # Two directories may be one, through a symlink
+                watched = self.watches.setdefault(wd, {})
+                for name, paths in names.items():
+                    known = watched.setdefault(name, [])
+                    known.extend(p for p in paths if p not in known)
+        except OSError:
+            inotify.close()
+            raise
+        self.inotify = inotify
+
+    def close(self):
+        '''Releases the inotify file descriptor, if any.'''
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def loop(self):
+        from select import select
+        while not self.stop:
+            if self.inotify is None:
+                self.iterate()
+            wait = self.pause_duration
+            due = self._due()
+            if due is not None and (wait is None or due < wait):
+                wait = due  # Wake up in time to deliver a batch
+            if self.inotify is None:
+                if wait:
+                    sleep(wait)
+            else:
+                select([self.inotify], [], [], wait)
+                self.iterate()
+
+    def _changed(self, path):
+        if not self.debounce:
+            self.callback(path)
+            return
+        self.last_change = monotonic()
+        if not self.pending:
+            self.first_change = self.last_change
+        self.pending.add(path)
+
+    def _due(self):
+        '''Returns how many seconds remain until the pending batch of
+        changes should be delivered, or None if there is none.
+        '''
+        if not self.pending:
+            return None
+        due = self.last_change + self.debounce
+        if self.max_delay is not None:
+            due = min(due, self.first_change + self.max_delay)
+        return max(0, due - monotonic())
+
+    def flush(self):
+        '''Calls the callback with the pending batch of changes, if any,
+        without waiting for the debounce window to end.
+        '''
+        if self.pending:
+            paths, self.pending = self.pending, set()
+            self.callback(paths)
+
+    def _read_events(self):
+        changed = OrderedDict()  # used as an ordered set
+        for wd, mask, cookie, name in self.inotify.read():
+            if mask & Inotify.IN_Q_OVERFLOW:  # Events were lost, so
+                paths = sorted(self.files)   # any file may have changed.
+            else:
+                paths = self.watches.get(wd, {}).get(name, ())
+            changed.update((p, None) for p in paths)
+        for path in changed:
+            self._changed(path)
 
     def filter(self, files):
         '''Massages the sequence of file paths received in the constructor.
@@ -44,25 +302,77 @@ class FileWatcher(PausingLooper):
 
     def iterate(self):
         '''Runs every so often to check if any files have changed.'''
+        if self.inotify is not None:
+            self._read_events()
+        else:
+            self._poll()
+        if self._due() == 0:
+            self.flush()
+
+    def _poll(self):
+        self.checks += 1
+        if self.backend == 'scandir':
+            changed = self._scan_directories()
+        else:
+            changed = self._stat_files()
+        if changed:
+            self.pause_duration = self.seconds
+        elif self.max_seconds:
+            self.pause_duration = min(self.pause_duration * 1.5,
+                                      self.max_seconds)
+
+    def _stat_files(self):
+        changed = False
         for path in self.files:
-            # 1) Get and validate old modification time
-            oldtime = self.mtimes.get(path, 0)  # First time it will be 0.
-            if oldtime is None:
+            if self.mtimes.get(path, 0) is None:
                 continue  # File must have been deleted. Skip it.
-            # 2) Obtain and validate current modification time
             try:
                 mtime = os.stat(path).st_mtime
             except OSError:  # File's not there.
                 mtime = None
-            # 3) Compare the times; update if necessary
-            if path not in self.mtimes:
-                # This must be the first check() run, so
-                # just add the path to the dictionary.
-                self.mtimes[path] = mtime
-            else:
-                if mtime is None or mtime > oldtime:
-                    self.mtimes[path] = mtime
-                    self.callback(path)
+            changed = self._compare(path, mtime) or changed
+        return changed
+
+    def _scan_directories(self):
+        full = self.rescan and self.checks % self.rescan == 0
+        changed = False
+        for directory, names in self.directories.items():
+            try:
+                directory_mtime = os.stat(directory).st_mtime
+            except OSError:
+                directory_mtime = None
+            if not full and directory in self.directory_mtimes and \
+                    self.directory_mtimes[directory] == directory_mtime:
+                continue  # No file was added, removed or replaced here
+            self.directory_mtimes[directory] = directory_mtime
+            mtimes = {}
+            try:
+                with listing(directory) as entries:
+                    for entry in entries:
+                        if entry.name in names:
+                            mtimes[entry.name] = entry.stat().st_mtime
+            except OSError:  # The directory's not there.
+                pass
+            for name, path in names.items():
+                if self.mtimes.get(path, 0) is not None:
+                    changed = self._compare(path, mtimes.get(name)) or \
+                        changed
+        return changed
+
+    def _compare(self, path, mtime):
+        '''Compares the modification time of a file (None if it has been
+        deleted) to the one seen before, and calls the callback if it
+        has changed. Returns whether it did.
+        '''
+        if path not in self.mtimes:
+            # This must be the first check() run, so
+            # just add the path to the dictionary.
+            self.mtimes[path] = mtime
+        elif mtime is None or mtime > self.mtimes[path]:
+            self.mtimes[path] = mtime
+            self._changed(path)
+            return True
+        return False
 
 
 class ModuleWatcher(FileWatcher):
@@ -118,3 +428,309 @@ class LoadedModulesWatcher(ModuleWatcher):
         from itertools import chain
         return super(LoadedModulesWatcher, self) \
             .filter(chain(files, self.get_loaded_modules_paths()))
+
+
+class DirectoryWatcher(PausingLooper):
+    '''When you call the loop() method, watches the files in some
+    *directories* and calls *callback* with the path of each file that
+    appears, changes or disappears. The files are chosen by the *files*
+    and *exclude* glob patterns and *recursive*, as in
+    bag.file_scanner.scan_files(). Changes that happened before this
+    object was created are not reported, except that with *initial*,
+    the first check passes every existing file to the callback, as if
+    it had just appeared.
+
+    On Linux the *backend* is inotify: each directory of the trees is
+    watched by the kernel (new subdirectories too), and a file is
+    reported when it is closed after writing, moved in or out, or
+    deleted; nothing is done while nothing happens. Elsewhere, or if
+    inotify fails (e.g. when there are too many directories for the
+    limit of watches), the trees are walked every *seconds* and
+    compared to the previous walk. Pass ``backend='poll'`` to always
+    poll, or ``backend='inotify'`` to raise OSError instead of falling
+    back. *snapshot* is a dictionary whose keys are the paths known.
+    '''
+    WATCH_MASK = (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO |
+                  Inotify.IN_MOVED_FROM | Inotify.IN_CREATE |
+                  Inotify.IN_DELETE | Inotify.IN_ONLYDIR)
+
+    def __init__(self, directories, callback, files='*', exclude=(),
+                 recursive=True, seconds=1.3, initial=False, backend='auto'):
+        if backend not in ('auto', 'inotify', 'poll'):
+            raise ValueError('Unknown backend: {0}'.format(backend))
+        self.directories = [directories] \
+            if isinstance(directories, basestring) else list(directories)
+        self.callback = callback
+        self.files = (files,) if isinstance(files, basestring) else files
+        self.exclude = (exclude,) if isinstance(exclude, basestring) \
+            else exclude
+        self.recursive = recursive
+        self.pause_duration = seconds
+        self.snapshot = {} if initial else None
+        self.inotify = None
+        self.unreported = []  # files found, to be reported with *initial*
+        if backend != 'poll':
+            try:
+                self._start_inotify(initial)
+            except OSError:
+                if backend == 'inotify':
+                    raise
+
+    def _start_inotify(self, initial):
+        self.inotify = Inotify()
+        self.watches = {}  # watch descriptor: directory
+        try:
+            found = []
+            for directory in self.directories:
+                found.extend(self._watch_tree(directory))
+        except OSError:
+            self.close()
+            raise
+        self.snapshot = dict.fromkeys(found)
+        if initial:
+            self.unreported = found
+
+    def _included(self, name):
+        return any(fnmatch(name, pattern) for pattern in self.files) and \
+            not self._excluded(name)
+
+    def _excluded(self, name):
+        return any(fnmatch(name, pattern) for pattern in self.exclude)
+
+    def _watch_tree(self, top):
+        '''Watches the directory *top* and, if recursive, its
+        subdirectories. Returns the files found in them, which are listed
+        after the watches are added, so none goes unnoticed.
+        '''
+        found = []
+        pending = [top]
+        while pending:
+            directory = pending.pop()
+            try:
+                wd = self.inotify.add_watch(directory, self.WATCH_MASK)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # It is gone already
+                raise
+            self.watches[wd] = directory
+            try:
+                with listing(directory) as entries:
+                    for entry in entries:
+                        if self._excluded(entry.name):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                pending.append(entry.path)
+                        elif entry.is_file() and self._included(entry.name):
+                            found.append(entry.path)
+            except OSError:
+                pass
+        return found
+
+    def _forget_tree(self, top):
+        '''Stops watching *top* and its subdirectories, which have been
+        moved away or deleted. Returns the files known to be there.
+        '''
+        prefix = os.path.join(top, '')
+        for wd, directory in list(self.watches.items()):
+            if directory == top or directory.startswith(prefix):
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass  # The kernel removed it already
+        gone = [path for path in self.snapshot if path.startswith(prefix)]
+        for path in gone:
+            del self.snapshot[path]
+        return gone
+
+    def close(self):
+        '''Releases the inotify file descriptor, if any.'''
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def loop(self):
+        from select import select
+        while not self.stop:
+            if self.inotify is None:  # Polling, maybe after a fallback
+                self.iterate()
+                if self.pause_duration:
+                    sleep(self.pause_duration)
+            else:
+                select([self.inotify], [], [], self.pause_duration)
+                self.iterate()
+
+    def scan(self):
+        '''Returns a dictionary of the paths currently found,
+        pointing to (inode, size, modification time) tuples.
+        '''
+        from .file_scanner import scan_files
+        current = {}
+        for directory in self.directories:
+            for path, stat in scan_files(directory, self.files, self.exclude,
+                                         self.recursive):
+                current[str(path)] = (
+                    stat.st_ino, stat.st_size, stat.st_mtime)
+        return current
+
+    def iterate(self):
+        '''Runs every so often to check if any files have changed.'''
+        if self.inotify is not None:
+            try:
+                changed = self._read_events()
+            except OSError:  # e.g. no more watches for a new directory
+                self.close()
+                self.snapshot = {}  # The next poll reports every file
+                changed = []
+            for path in changed:
+                self.callback(path)
+            return
+        current = self.scan()
+        previous, self.snapshot = self.snapshot, current
+        if previous is None:
+            return  # This is the first check
+        for path, signature in current.items():
+            if previous.get(path) != signature:
+                self.callback(path)
+        for path in previous:
+            if path not in current:
+                self.callback(path)
+
+    def _read_events(self):
+        changed = OrderedDict.fromkeys(self.unreported)
+        self.unreported = []
+        for wd, mask, cookie, name in self.inotify.read():
+            if mask & Inotify.IN_Q_OVERFLOW:  # Events were lost; list all.
+                found = []
+                for directory in self.directories:
+                    found.extend(self._watch_tree(directory))
+                previous, self.snapshot = self.snapshot, dict.fromkeys(found)
+                changed.update((path, None) for path in found)
+                changed.update((path, None) for path in previous
+                               if path not in self.snapshot)
+                continue
+            directory = self.watches.get(wd)
+            if mask & Inotify.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None or not name or self._excluded(name):
+                continue
+            path = os.path.join(directory, name)
+            if mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_MOVED_FROM | Inotify.IN_DELETE):
+                    changed.update((p, None) for p in self._forget_tree(path))
+                elif self.recursive:  # created or moved in
+                    found = self._watch_tree(path)
+                    self.snapshot.update((p, None) for p in found)
+                    changed.update((p, None) for p in found)
+            elif not self._included(name):
+                continue
+            elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                self.snapshot[path] = None
+                changed[path] = None
+            elif mask & (Inotify.IN_MOVED_FROM | Inotify.IN_DELETE):
+                if path in self.snapshot:
+                    del self.snapshot[path]
+                    changed[path] = None
+        return list(changed)
+
+
+class AsyncFileWatcher(object):
+    '''Watches *files* for an asyncio program, as an async iterator of
+    the changed paths::
+
+        async for path in AsyncFileWatcher(['settings.ini']):
+            reload_settings(path)
+
+    The keyword arguments are those of FileWatcher, which does the
+    work, except for the callback. With inotify, the event loop watches
+    its file descriptor (loop.add_reader()), so nothing runs until the
+    kernel reports a change. Otherwise the files are polled every
+    *seconds* by a timer of the event loop, whose thread is never put to
+    sleep. With *debounce*, sets of paths are produced instead.
+    Call close() to stop watching and end the iteration.
+    '''
+
+    def __init__(self, files, **kw):
+        from collections import deque
+        self.changes = deque()
+        self.watcher = FileWatcher(files, self._deliver, **kw)
+        self.loop = None
+        self.closed = False
+        self._waiter = None
+        self._timer = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self.loop is None:
+            self._start()
+        future = self.loop.create_future()
+        if self.changes:
+            future.set_result(self.changes.popleft())
+        elif self.closed:
+            raise StopAsyncIteration
+        else:
+            self._waiter = future
+        return future
+
+    def _start(self):
+        import asyncio
+        self.loop = asyncio.get_event_loop()
+        if self.watcher.inotify is None:
+            self.watcher.iterate()  # Take note of the current mtimes
+        else:
+            self.loop.add_reader(self.watcher.inotify.fileno(), self._tick)
+        self._schedule()
+
+    def _deliver(self, change):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(change)
+        else:
+            self.changes.append(change)
+
+    def _tick(self):
+        self.watcher.iterate()
+        self._schedule()
+
+    def _schedule(self):
+        '''Sets a timer for the next poll or the next batch of changes.'''
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        delay = self.watcher._due()
+        pause = self.watcher.pause_duration or 0
+        if self.watcher.inotify is None and (delay is None or pause < delay):
+            delay = pause
+        if delay is not None and not self.closed:
+            self._timer = self.loop.call_later(delay, self._tick)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.loop is not None:
+            if self._timer is not None:
+                self._timer.cancel()
+            if self.watcher.inotify is not None:
+                self.loop.remove_reader(self.watcher.inotify.fileno())
+        self.watcher.close()
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_exception(StopAsyncIteration())
+
+
+if __name__ == '__main__':
+    from time import time
+    # Benchmark: the cost of checking all loaded modules while idle
+    import email.mime.multipart, json, logging.handlers, unittest  # noqa
+    for backend in ('poll', 'scandir', 'inotify'):
+        watcher = LoadedModulesWatcher([], print, backend=backend)
+        watcher.iterate()
+        start = time()
+        for i in range(100):
+            watcher.iterate()
+        print('{0:<8} {1} files: {2:.3f} ms per check'.format(
+            backend, len(watcher.files), (time() - start) * 10))
+        watcher.close()
@@ -2,47 +2,1046 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
-from functools import wraps
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial, wraps
+from hashlib import sha1
+from struct import Struct
+from threading import Event, Lock, Thread
+from weakref import ref, WeakSet
+import inspect
+import sys
+import time
+try:
+    from cPickle import dumps, loads, HIGHEST_PROTOCOL
+except ImportError:
+    from pickle import dumps, loads, HIGHEST_PROTOCOL
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from ordereddict import OrderedDict
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
 # Instead of wrapper.__doc__ = f.__doc__ and wrapper.__name__ = f.__name__,
 # use functools.wraps.
 
+# A clock that does not jump when the system time is adjusted
+now = getattr(time, 'monotonic', time.time)
 
-def memoize(limit=None, keymaker=None, cache_type=dict, debug=False):
+_missing = object()
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions expirations '
+                       'size limit bytes max_bytes')
+
+
+def estimate_size(value):
+    '''Default size estimator for caches with ``max_bytes``. Returns the
+        approximate number of bytes used by ``value``: sys.getsizeof(),
+        which is exact for str and bytes, plus the size of the items of
+        lists, tuples, sets and dicts (one level deep).
+        '''
+    size = sys.getsizeof(value)
+    if isinstance(value, (str, bytes, bytearray)):
+        return size
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for item in value:
+            size += sys.getsizeof(item)
+    return size
+
+
+class LRUCache(object):
+    '''Mapping that discards the least recently used item when it grows
+        beyond ``limit`` entries. All operations are O(1): recency is kept
+        by the order of an OrderedDict instead of a list.
+
+        If ``ttl`` (in seconds) is given, each entry also expires that long
+        after it was stored. Expired entries are never returned; they are
+        discarded lazily when looked up, or in bulk by ``sweep()``.
+
+        If ``max_bytes`` is given, the least recently used entries are also
+        discarded while the values add up to more than that.
+        Each value is measured once, when stored, by the ``sizeof``
+        function, which defaults to estimate_size().
+
+        A ``tier`` (such as SqliteTier) can hold a second, larger level of
+        the cache under ``namespace``: misses are looked up there,
+        and stored values are written through to it.
+
+        Also counts hits, misses, evictions and expirations; see ``info()``.
+
+        This class does not lock by itself; code that shares an instance
+        between threads should hold its ``lock`` while using it.
+        '''
+
+    def __init__(self, limit=None, ttl=None, max_bytes=None,
+                 sizeof=estimate_size, tier=None, namespace=None):
+        self.limit = limit
+        self.tier = tier
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.sizes = {}  # only used with max_bytes
+        self.total_bytes = 0
+        self.data = OrderedDict()
+        # Deadlines in the order they were written, which (since the ttl
+        # is the same for every entry) is also the order they expire in.
+        self.deadlines = OrderedDict()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.lock = Lock()
+
+    def __getitem__(self, key):
+        '''Returns the value and marks it as the most recently used.'''
+        value = self.data.pop(key, _missing)
+        if value is not _missing and self.ttl is not None and \
+                self.deadlines.get(key, 0) <= now():
+            self.deadlines.pop(key, None)
+            self._forget_size(key)
+            self.expirations += 1
+            value = _missing
+        if value is _missing:
+            found = None if self.tier is None else \
+                self.tier.get(self.namespace, key)
+            if found is None or (self.ttl is not None and
+                                 found[1] >= self.ttl):
+                self.misses += 1
+                raise KeyError(key)
+            value = found[0]
+            self._put(key, value, age=found[1])
+        else:
+            self.data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._put(key, value)
+        if self.tier is not None:
+            self.tier.set(self.namespace, key, value)
+
+    def _put(self, key, value, age=0):
+        '''Stores in memory only. ``age`` is how many seconds ago
+            the value was computed.
+            '''
+        self.data.pop(key, None)
+        self.data[key] = value
+        if self.ttl is not None:
+            self.deadlines.pop(key, None)
+            # Values from the tier may be out of order here (age > 0),
+            # which only makes sweep() leave them for lazy expiry.
+            self.deadlines[key] = now() + self.ttl - age
+        if self.max_bytes is not None:
+            self._forget_size(key)
+            size = self.sizes[key] = self.sizeof(value)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                self._evict()
+        if self.limit is not None:
+            while len(self.data) > self.limit:
+                self._evict()
+
+    def _evict(self):
+        old_key = self.data.popitem(last=False)[0]
+        self.deadlines.pop(old_key, None)
+        self._forget_size(old_key)
+        self.evictions += 1
+
+    def _forget_size(self, key):
+        if self.sizes:
+            self.total_bytes -= self.sizes.pop(key, 0)
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.deadlines.pop(key, None)
+        self._forget_size(key)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def estimated_bytes(self):
+        '''Returns the memory used by the values, as measured by ``sizeof``.
+            Unless ``max_bytes`` is set, this measures every value now,
+            so it takes a while on large caches.
+            '''
+        if self.max_bytes is not None:
+            return self.total_bytes
+        return sum(self.sizeof(value) for value in list(self.data.values()))
+
+    def warm(self):
+        '''Loads into memory the values found in the second tier, e.g.
+            at startup, so they are ready before the first request.
+            Returns how many values were loaded.
+            '''
+        count = 0
+        for key, value, age in self.tier.items(self.namespace):
+            if self.ttl is None or age < self.ttl:
+                self._put(key, value, age=age)
+                count += 1
+        return count
+
+    def clear(self):
+        '''Discards all entries (including those in the second tier)
+            and resets the statistics.
+            '''
+        if self.tier is not None:
+            self.tier.clear(self.namespace)
+        self.data.clear()
+        self.deadlines.clear()
+        self.sizes.clear()
+        self.total_bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def sweep(self):
+        '''Discards every expired entry. Returns how many were discarded.
+
+            The cost is proportional to the number of expired entries,
+            since they are found at the front of ``deadlines``.
+            '''
+        count = 0
+        moment = now()
+        with self.lock:
+            while self.deadlines:
+                try:
+                    key, deadline = next(iter(self.deadlines.items()))
+                except (StopIteration, RuntimeError):
+                    break  # Changed by another thread; try again next time.
+                if deadline > moment:
+                    break
+                self.deadlines.pop(key, None)
+                self._forget_size(key)
+                if self.data.pop(key, _missing) is not _missing:
+                    count += 1
+            self.expirations += count
+        return count
+
+    def start_sweeper(self, interval):
+        '''Starts a daemon thread that calls ``sweep()`` every ``interval``
+            seconds, so expired entries stop using memory even if they are
+            never looked up again. The thread ends when this cache is
+            garbage collected.
+            '''
+        thread = Thread(target=_sweep_periodically,
+                        args=(ref(self), interval),
+                        name='memoize sweeper')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def info(self):
+        return CacheInfo(
+            self.hits, self.misses, self.evictions, self.expirations,
+            len(self.data), self.limit,
+            None if self.max_bytes is None else self.total_bytes,
+            self.max_bytes)
+
+
+def _sweep_periodically(cache_ref, interval):
+    while True:
+        time.sleep(interval)
+        cache = cache_ref()
+        if cache is None:
+            return
+        cache.sweep()
+        del cache
+
+
+class MappingCache(object):
+    '''Cache engine that keeps the values in a mapping of ``mapping_type``,
+        such as dict or WeakValueDictionary (whose values disappear when
+        nothing else uses them, which then counts as a miss), and discards
+        the least recently used key beyond ``limit`` keys. memoize() uses
+        this when its ``cache_type`` is a mapping class rather than a cache
+        engine. ``ttl``, ``max_bytes`` and ``tier`` are not supported.
+        '''
+
+    def __init__(self, mapping_type, limit=None, ttl=None, max_bytes=None,
+                 sizeof=estimate_size, tier=None, namespace=None):
+        if ttl is not None or max_bytes is not None or tier is not None:
+            raise TypeError('A cache_type that is a mapping class does not '
+                            'support ttl, max_bytes nor tier.')
+        self.mapping = mapping_type()
+        self.limit = limit
+        self.ttl = self.max_bytes = self.tier = None
+        self.sizeof = sizeof
+        self.namespace = namespace
+        self.data = OrderedDict()  # the keys, least recently used first
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.lock = Lock()
+
+    def __getitem__(self, key):
+        self.data.pop(key, None)
+        try:
+            value = self.mapping[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.data[key] = None
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self.mapping[key] = value
+        self.data.pop(key, None)
+        self.data[key] = None
+        if self.limit is not None:
+            while len(self.data) > self.limit:
+                self.mapping.pop(self.data.popitem(last=False)[0], None)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        self.data.pop(key, None)
+        del self.mapping[key]
+
+    def __contains__(self, key):
+        return key in self.mapping
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def __iter__(self):
+        return iter(list(self.mapping.keys()))
+
+    def estimated_bytes(self):
+        return sum(self.sizeof(value)
+                   for value in list(self.mapping.values()))
+
+    def clear(self):
+        self.mapping.clear()
+        self.data.clear()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.expirations, len(self.mapping), self.limit,
+                         None, None)
+
+
+class SqliteTier(object):
+    '''A second cache tier for memoize, stored in a local SQLite file, so
+        cached values survive restarts. Example::
+
+            disk = SqliteTier('/var/cache/myapp/memoize.sqlite', ttl=3600)
+
+            @memoize(1000, tier=disk, warm=True)
+            def expensive_query(user_id):
+                ...
+
+        Many functions can share one instance; each gets its own namespace.
+        Values are serialized by the ``dumps`` and ``loads`` functions
+        (pickle by default), and are discarded when they are older than
+        ``ttl`` seconds, or when they can no longer be loaded (e.g. after
+        a deploy renamed their class). Keys are pickled, so they must be
+        picklable.
+        '''
+
+    def __init__(self, path='./memoize.sqlite', ttl=None,
+                 dumps=lambda value: dumps(value, HIGHEST_PROTOCOL),
+                 loads=loads):
+        import sqlite3
+        self.binary = sqlite3.Binary
+        self.ttl = ttl
+        self.dumps = dumps
+        self.loads = loads
+        self.lock = Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS memoize (namespace TEXT NOT NULL, '
+            'key BLOB NOT NULL, value BLOB NOT NULL, stored REAL NOT NULL, '
+            'PRIMARY KEY (namespace, key))')
+
+    def _execute(self, sql, *params):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def _dump_key(self, key):
+        return self.binary(dumps(key, 2))  # a fixed protocol for stable keys
+
+    def get(self, namespace, key):
+        '''Returns a tuple (value, age in seconds), or None.'''
+        dumped_key = self._dump_key(key)
+        rows = self._execute(
+            'SELECT value, stored FROM memoize WHERE namespace=? AND key=?',
+            namespace, dumped_key)
+        if not rows:
+            return None
+        age = time.time() - rows[0][1]
+        if self.ttl is not None and age >= self.ttl:
+            return None
+        try:
+            return self.loads(bytes(rows[0][0])), age
+        except Exception:  # e.g. its class was renamed since it was stored
+            self._discard(namespace, dumped_key)
+            return None
+
+    def set(self, namespace, key, value):
+        self._execute(
+            'INSERT OR REPLACE INTO memoize VALUES (?, ?, ?, ?)', namespace,
+            self._dump_key(key), self.binary(self.dumps(value)), time.time())
+
+    def items(self, namespace):
+        '''Returns a list of (key, value, age) tuples for the values that
+            have not expired, oldest first.
+            '''
+        moment = time.time()
+        items = []
+        for key, value, stored in self._execute(
+                'SELECT key, value, stored FROM memoize '
+                'WHERE namespace=? AND stored>? ORDER BY stored',
+                namespace, -1 if self.ttl is None else moment - self.ttl):
+            try:
+                items.append((loads(bytes(key)), self.loads(bytes(value)),
+                              moment - stored))
+            except Exception:  # e.g. a class renamed since it was stored
+                self._discard(namespace, key)
+        return items
+
+    def _discard(self, namespace, dumped_key):
+        '''Deletes a row that can no longer be unpickled, so the next
+            call computes its value again.
+            '''
+        self._execute('DELETE FROM memoize WHERE namespace=? AND key=?',
+                      namespace, dumped_key)
+
+    def clear(self, namespace):
+        self._execute('DELETE FROM memoize WHERE namespace=?', namespace)
+
+    def purge(self):
+        '''Deletes expired values from the file.'''
+        if self.ttl is not None:
+            self._execute('DELETE FROM memoize WHERE stored<=?',
+                          time.time() - self.ttl)
+
+    def close(self):
+        self.connection.close()
+
+
+class SharedMemoryCache(object):
+    '''Cache engine whose entries live in a memory-mapped file, so that all
+        processes on one host -- such as the workers forked by gunicorn --
+        share a single copy of the cache. Use it as memoize's cache_type,
+        with a ``directory`` that belongs to your application::
+
+            shared = partial(SharedMemoryCache, directory='/dev/shm/myapp')
+
+            @memoize(10000, cache_type=shared)
+            def expensive(a, b):
+                ...
+
+        The file is a hash table of ``limit`` slots of ``slot_size`` bytes,
+        grouped in buckets of 8 slots. Each bucket is locked separately
+        (with fcntl byte-range locks), so processes only wait for each other
+        when they use the same bucket. A full bucket discards its least
+        recently used entry, which approximates LRU for the whole cache.
+
+        Keys and values are pickled; a pair that does not fit in a slot is
+        just not cached. The file is created in ``directory`` and named
+        after the function and the size of the table, so processes that
+        disagree on ``limit`` or ``slot_size`` (say, during a deploy that
+        changes them) use separate files. Alternatively, pass the ``path``
+        of the file; a file of another size then raises ValueError.
+        A file in use is never resized, which would crash the processes
+        that have it mapped.
+
+        Every process that uses the same file sees the same values, and
+        the files outlive the processes. So use a directory (in /dev/shm
+        for speed) that no other application writes to, and empty it when
+        the application starts (e.g. in the master process of gunicorn,
+        before forking) or when it is deployed, since old values and
+        files of old sizes remain there otherwise. remove() deletes the
+        file of one cache.
+
+        To pass these arguments, use functools.partial as the cache_type.
+        ``max_bytes`` and ``tier`` are not supported.
+        Hit and miss counts are per process. Unix only.
+        '''
+    ways = 8
+    magic = b'bagmemo1'
+    header = Struct('<8sII')
+    header_size = 64
+    # state, key hash, key length, value length, deadline, last use
+    slot_header = Struct('<BxxxQIIdd')
+    last_use = Struct('<d')
+    last_use_offset = 28
+    USED = 1
+
+    def __init__(self, limit=None, ttl=None, max_bytes=None, sizeof=None,
+                 tier=None, namespace=None, directory=None, path=None,
+                 slot_size=4096):
+        if max_bytes is not None or tier is not None:
+            raise TypeError(
+                'SharedMemoryCache does not support max_bytes nor tier.')
+        if path is None and directory is None:
+            raise TypeError('SharedMemoryCache needs a directory or a path '
+                            'that belongs to this application.')
+        import fcntl
+        import os
+        self.fcntl = fcntl
+        self.limit = limit
+        self.ttl = ttl
+        self.namespace = namespace
+        self.tier = None
+        self.slot_size = slot_size
+        self.buckets = -(-(limit or 4096) // self.ways)
+        self.slots = self.buckets * self.ways
+        if path is None:
+            path = os.path.join(directory, '{0}-{1}x{2}.mmap'.format(
+                namespace or 'default', self.slots, slot_size))
+        self.path = path
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self.lock = Lock()
+
+        size = self.header_size + self.slots * slot_size
+        header = self.header.pack(self.magic, self.slots, slot_size)
+        # fcntl locks belong to the process, not to the file descriptor:
+        # closing any descriptor of the file releases them all. So the
+        # instances of one process that use a file share one descriptor,
+        # and a lock that excludes their threads from each other.
+        self._key = os.path.realpath(path)
+        with _shared_files_lock:
+            shared = _shared_files.get(self._key)
+            if shared is None:
+                shared = self._open(path, size, header)
+                _shared_files[self._key] = shared
+            elif len(shared.map) != size or \
+                    shared.map[:len(header)] != header:
+                raise self._mismatch()
+            shared.users += 1
+        self.shared = shared
+        self.fd = shared.fd
+        self.map = shared.map
+        self._local_lock = shared.lock
+
+    def _mismatch(self):
+        return ValueError('{0} is not a SharedMemoryCache of {1} slots of '
+                          '{2} bytes.'.format(
+                              self.path, self.slots, self.slot_size))
+
+    def _open(self, path, size, header):
+        import mmap
+        import os
+        fcntl = self.fcntl
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, self.header_size, 0)
+            current_size = os.fstat(fd).st_size
+            if current_size == 0:  # A new file: set it up.
+                os.ftruncate(fd, size)
+                os.write(fd, header)
+            elif current_size != size or os.read(fd, len(header)) != header:
+                raise self._mismatch()
+            shared = _SharedFile(fd, mmap.mmap(fd, size))
+            fcntl.lockf(fd, fcntl.LOCK_UN, self.header_size, 0)
+        except BaseException:
+            os.close(fd)  # which also releases the lock
+            raise
+        return shared
+
+    @contextmanager
+    def _locked(self, bucket=None):
+        '''Locks one bucket, or the whole table if ``bucket`` is None,
+            while also holding a shared lock of the header, which a process
+            that sets up the file holds exclusively.
+            '''
+        if bucket is None:
+            start, length = self.header_size, self.slots * self.slot_size
+        else:
+            length = self.ways * self.slot_size
+            start = self.header_size + bucket * length
+        lockf = self.fcntl.lockf
+        with self._local_lock:
+            lockf(self.fd, self.fcntl.LOCK_SH, self.header_size, 0)
+            try:
+                lockf(self.fd, self.fcntl.LOCK_EX, length, start)
+                try:
+                    yield
+                finally:
+                    lockf(self.fd, self.fcntl.LOCK_UN, length, start)
+            finally:
+                lockf(self.fd, self.fcntl.LOCK_UN, self.header_size, 0)
+
+    def _hash(self, key_bytes):
+        '''Returns the key hash and its bucket. Unlike hash(), this is
+            the same in every process.
+            '''
+        h = Struct('<Q').unpack(sha1(key_bytes).digest()[:8])[0]
+        return h, h % self.buckets
+
+    def _offsets(self, bucket=None):
+        if bucket is None:
+            first, count = self.header_size, self.slots
+        else:
+            first = self.header_size + bucket * self.ways * self.slot_size
+            count = self.ways
+        return range(first, first + count * self.slot_size, self.slot_size)
+
+    def _find(self, bucket, h, key_bytes):
+        '''Returns (offset, key length, value length, deadline) of the slot
+            that holds the key, or None.
+            '''
+        for offset in self._offsets(bucket):
+            state, slot_hash, key_len, value_len, deadline, used = \
+                self.slot_header.unpack_from(self.map, offset)
+            if state == self.USED and slot_hash == h:
+                start = offset + self.slot_header.size
+                if self.map[start:start + key_len] == key_bytes:
+                    return offset, key_len, value_len, deadline
+
+    def _free(self, offset):
+        self.map[offset:offset + 1] = b'\0'
+
+    def __getitem__(self, key):
+        key_bytes = dumps(key, 2)
+        h, bucket = self._hash(key_bytes)
+        value_bytes = None
+        with self._locked(bucket):
+            found = self._find(bucket, h, key_bytes)
+            if found is not None:
+                offset, key_len, value_len, deadline = found
+                moment = time.time()
+                if deadline and deadline <= moment:
+                    self._free(offset)
+                    self.expirations += 1
+                else:
+                    self.last_use.pack_into(
+                        self.map, offset + self.last_use_offset, moment)
+                    start = offset + self.slot_header.size + key_len
+                    value_bytes = self.map[start:start + value_len]
+        if value_bytes is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return loads(value_bytes)
+
+    def __setitem__(self, key, value):
+        key_bytes = dumps(key, 2)
+        value_bytes = dumps(value, HIGHEST_PROTOCOL)
+        data = key_bytes + value_bytes
+        if self.slot_header.size + len(data) > self.slot_size:
+            return  # too large to be cached
+        h, bucket = self._hash(key_bytes)
+        moment = time.time()
+        deadline = 0 if self.ttl is None else moment + self.ttl
+        with self._locked(bucket):
+            found = self._find(bucket, h, key_bytes)
+            if found is None:
+                offset = victim = oldest = None
+                for slot in self._offsets(bucket):
+                    state, _, _, _, slot_deadline, used = \
+                        self.slot_header.unpack_from(self.map, slot)
+                    if state != self.USED or \
+                            (slot_deadline and slot_deadline <= moment):
+                        offset = slot
+                        break
+                    if oldest is None or used < oldest:
+                        victim, oldest = slot, used
+                if offset is None:
+                    offset = victim
+                    self.evictions += 1
+            else:
+                offset = found[0]
+            self.slot_header.pack_into(
+                self.map, offset, self.USED, h, len(key_bytes),
+                len(value_bytes), deadline, moment)
+            start = offset + self.slot_header.size
+            self.map[start:start + len(data)] = data
+
+    def __delitem__(self, key):
+        key_bytes = dumps(key, 2)
+        h, bucket = self._hash(key_bytes)
+        with self._locked(bucket):
+            found = self._find(bucket, h, key_bytes)
+            if found is None:
+                raise KeyError(key)
+            self._free(found[0])
+
+    def __contains__(self, key):
+        key_bytes = dumps(key, 2)
+        h, bucket = self._hash(key_bytes)
+        with self._locked(bucket):
+            found = self._find(bucket, h, key_bytes)
+        return found is not None and not (
+            found[3] and found[3] <= time.time())
+
+    def _live_slots(self):
+        '''Generates the offset and header of every unexpired entry.
+            Does not lock, so the result is approximate.
+            '''
+        moment = time.time()
+        for offset in self._offsets():
+            fields = self.slot_header.unpack_from(self.map, offset)
+            if fields[0] == self.USED and not (
+                    fields[4] and fields[4] <= moment):
+                yield offset, fields
+
+    def __len__(self):
+        return sum(1 for slot in self._live_slots())
+
+    def __iter__(self):
+        for offset, fields in self._live_slots():
+            start = offset + self.slot_header.size
+            yield loads(self.map[start:start + fields[2]])
+
+    def clear(self):
+        '''Discards the entries of all processes and resets the statistics
+            of this one.
+            '''
+        with self._locked():
+            for offset in self._offsets():
+                self._free(offset)
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def sweep(self):
+        '''Discards every expired entry. Returns how many were discarded.'''
+        count = 0
+        moment = time.time()
+        for bucket in range(self.buckets):
+            with self._locked(bucket):
+                for offset in self._offsets(bucket):
+                    state, _, _, _, deadline, used = \
+                        self.slot_header.unpack_from(self.map, offset)
+                    if state == self.USED and deadline and deadline <= moment:
+                        self._free(offset)
+                        count += 1
+        self.expirations += count
+        return count
+
+    def start_sweeper(self, interval):
+        '''Starts a daemon thread that calls ``sweep()`` every ``interval``
+            seconds, until this cache is garbage collected.
+            '''
+        thread = Thread(target=_sweep_periodically,
+                        args=(ref(self), interval),
+                        name='memoize sweeper')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def estimated_bytes(self):
+        '''Returns the size of the pickled values in the shared file.'''
+        return sum(fields[3] for offset, fields in self._live_slots())
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions,
+                         self.expirations, len(self), self.slots, None, None)
+
+    def close(self):
+        '''Stops using the file, which is closed once no other instance
+            in this process uses it.
+            '''
+        import os
+        shared, self.shared = self.shared, None
+        if shared is None:
+            return  # already closed
+        with _shared_files_lock:
+            shared.users -= 1
+            if shared.users:
+                return
+            if _shared_files.get(self._key) is shared:
+                del _shared_files[self._key]
+        shared.map.close()
+        os.close(shared.fd)
+
+    def remove(self):
+        '''Closes this cache and deletes its file. Other instances and
+            processes that still have the file open go on sharing it among
+            themselves; new ones create another file.
+            '''
+        import os
+        with _shared_files_lock:
+            if _shared_files.get(self._key) is self.shared:
+                del _shared_files[self._key]
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _SharedFile(object):
+    '''A file mapped by the SharedMemoryCache instances of this process.'''
+
+    def __init__(self, fd, map):
+        self.fd = fd
+        self.map = map
+        self.lock = Lock()  # fcntl locks do not exclude threads
+        self.users = 0
+
+
+_shared_files = {}  # real path: _SharedFile
+_shared_files_lock = Lock()
+
+
+def pickle_key(*a, **kw):
+    '''Builds a cache key by pickling the arguments. Slow, but works
+        for any picklable arguments, hashable or not.
+        '''
+    return dumps((a, kw))
+
+
+class _KwargsMark(object):
+    '''Separates positional from keyword arguments in cache keys.
+        Unpickles as the same object, so keys survive a SqliteTier.
+        '''
+
+    def __reduce__(self):
+        return '_KWARGS_MARK'
+
+
+_KWARGS_MARK = _KwargsMark()
+_kwargs_mark = (_KWARGS_MARK,)
+_fast_types = frozenset((int, str))
+
+
+def make_key(*a, **kw):
+    '''Builds a cache key out of the arguments themselves, which is much
+        faster than pickling them. Keyword arguments are sorted, so their
+        order does not matter. Falls back to pickle_key() when some
+        argument is unhashable (e.g. a list or a dict).
+
+        As with dictionaries, arguments that compare equal (such as 1, 1.0
+        and True) usually produce the same key. The exception is a single
+        positional int or str, which is its own key for speed, so f(1) is
+        cached apart from f(1.0) and f(True).
+        '''
+    if kw:
+        key = a + _kwargs_mark + tuple(sorted(kw.items()))
+    elif len(a) == 1 and type(a[0]) in _fast_types:
+        return a[0]
+    else:
+        key = a
+    try:
+        hash(key)
+    except TypeError:
+        return pickle_key(*a, **kw)
+    return key
+
+
+class _InFlight(object):
+    '''The result of a computation that other threads may be waiting for.'''
+
+    def __init__(self):
+        self.event = Event()
+        self.value = self.error = None
+
+    def set(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+_registry = WeakSet()  # every function decorated with memoize()
+
+
+def memoized_functions():
+    '''Returns the memoized functions that still exist, sorted by name.'''
+    return sorted(_registry, key=lambda fn: fn.cache.namespace)
+
+
+def cache_report():
+    '''Returns a list with a dictionary per memoized function, containing
+        its name, the fields of its CacheInfo, the approximate ``bytes``
+        used by its values and its ``hit_ratio``. The largest caches come
+        first, so this tells you which functions own the memory.
+        '''
+    report = []
+    for fn in memoized_functions():
+        info = fn.cache_info()
+        lookups = info.hits + info.misses
+        adict = info._asdict()
+        adict.update(function=fn.cache.namespace,
+                     bytes=fn.cache.estimated_bytes(),
+                     hit_ratio=info.hits / lookups if lookups else None)
+        report.append(adict)
+    report.sort(key=lambda adict: adict['bytes'], reverse=True)
+    return report
+
+
+def clear_caches(prefix=''):
+    '''Clears the caches of the memoized functions whose names
+        (such as ``my.module.MyClass.method``) start with ``prefix``.
+        Returns how many caches were cleared.
+        '''
+    functions = [fn for fn in memoized_functions()
+                 if fn.cache.namespace.startswith(prefix)]
+    for fn in functions:
+        fn.cache_clear()
+    return len(functions)
+
+
+def memoize(limit=None, keymaker=None, cache_type=LRUCache, debug=False,
+            ttl=None, sweep_interval=None, thread_safe=False,
+            max_bytes=None, sizeof=estimate_size, tier=None, warm=False):
     '''memoize decorator with a lru cache.
     When full, the cache discards the least recently used value.
-    You can pass cache_type=WeakValueDictionary (not tested).
+
+    With ``ttl`` (seconds), a value is recomputed once it is older than
+    that. Expired values are dropped when next requested; if you also
+    pass ``sweep_interval`` (seconds), a background thread drops them
+    periodically, releasing their memory. The cache is then always used
+    under its lock, which the sweeper thread takes too.
+
+    ``max_bytes`` bounds the memory used by the cached values, as measured
+    by the ``sizeof`` function (by default, estimate_size()), by
+    discarding the least recently used ones. It can be combined with
+    ``limit``, which counts entries.
+
+    ``tier`` adds a second, persistent level to the cache, such as a
+    SqliteTier instance, which is looked up when a value is not in memory.
+    With ``warm=True``, values are loaded from the tier into memory right
+    away; you can also call ``wrapper.cache.warm()`` at startup.
+
+    Pass ``thread_safe=True`` when the function is called from several
+    threads, e.g. in a threaded WSGI server. The cache is then used
+    under a lock and, when many threads miss the same key at once,
+    only one of them runs the function; the others wait for its result
+    (or its exception) instead of stampeding.
+
+    Coroutine functions (``async def``) are supported: their results are
+    cached, not the coroutine objects, and concurrent awaits of the same
+    key share a single execution. The memoized function is a coroutine
+    function too.
+
+    Every memoized function is registered, so cache_report() and
+    clear_caches() can reach them all.
+
+    The decorated function gains a ``cache_info()`` method that returns
+    a CacheInfo namedtuple
+    (hits, misses, evictions, expirations, size, limit, bytes, max_bytes),
+    useful to size caches from production data,
+    and a ``cache_clear()`` method.
+
+    ``keymaker`` receives the same arguments as the function and returns
+    a hashable cache key; the default is make_key().
+
+    ``cache_type`` is the class of the cache engine; it is instantiated
+    with the ``limit``, ``ttl``, ``max_bytes``, ``sizeof``, ``tier`` and
+    ``namespace`` and must behave like LRUCache. For a cache shared by
+    the processes of a forking server, use SharedMemoryCache.
+    A mapping class, such as dict or WeakValueDictionary, can also be
+    passed as before; it is then wrapped in a MappingCache.
+
+    ``wrapper.popular`` is a live view of the cached keys, from the least
+    to the most recently used (None for SharedMemoryCache).
     '''
     if not keymaker:
-        try:
-            from cPickle import dumps
-        except ImportError:
-            from pickle import dumps
-        keymaker = lambda *a, **kw: dumps((a, kw))
+        keymaker = make_key
+
+    engine = cache_type
+    if isinstance(cache_type, type) and issubclass(cache_type, MutableMapping):
+        engine = partial(MappingCache, cache_type)
 
     def decoratr(fn):
-        cache = cache_type()
-        popular = []
+        cache = engine(
+            limit, ttl=ttl, max_bytes=max_bytes, sizeof=sizeof, tier=tier,
+            namespace='{0}.{1}'.format(
+                fn.__module__, getattr(fn, '__qualname__', fn.__name__)))
+        if tier is not None and warm:
+            cache.warm()
+        sweeping = ttl is not None and bool(sweep_interval)
+        if sweeping:
+            cache.start_sweeper(sweep_interval)
 
         @wraps(fn)
-        def wrapper(*a, **kw):
+        def plain_wrapper(*a, **kw):
             key = keymaker(*a, **kw)
             try:
-                popular.append(popular.pop(popular.index(key)))
-            except ValueError:
-                cache[key] = fn(*a, **kw)
-                popular.append(key)
-                if limit is not None and len(popular) > limit:
-                    del cache[popular.pop(0)]
+                value = cache[key]
+            except KeyError:
+                value = cache[key] = fn(*a, **kw)
             else:
                 if debug:
                     print('Hit cache of {0}(). Value:\n  {1}'.format(
                         fn.__name__, key))
-            return cache[key]
+            return value
+
+        pending = {}  # keys being computed right now, for thread_safe mode
+        lock = cache.lock
+
+        @wraps(fn)
+        def locked_wrapper(*a, **kw):
+            '''Like plain_wrapper, but shares the cache with the sweeper.'''
+            key = keymaker(*a, **kw)
+            with lock:
+                try:
+                    value = cache[key]
+                except KeyError:
+                    value = _missing
+            if value is _missing:
+                value = fn(*a, **kw)  # without the lock, since it may recurse
+                with lock:
+                    cache[key] = value
+            elif debug:
+                print('Hit cache of {0}(). Value:\n  {1}'.format(
+                    fn.__name__, key))
+            return value
+
+        @wraps(fn)
+        def safe_wrapper(*a, **kw):
+            key = keymaker(*a, **kw)
+            with lock:
+                try:
+                    value = cache[key]
+                except KeyError:
+                    call = pending.get(key)
+                    leader = call is None
+                    if leader:
+                        call = pending[key] = _InFlight()
+                else:
+                    if debug:
+                        print('Hit cache of {0}(). Value:\n  {1}'.format(
+                            fn.__name__, key))
+                    return value
+            if not leader:
+                return call.wait()
+            try:
+                value = fn(*a, **kw)
+            except BaseException as e:
+                with lock:
+                    del pending[key]
+                call.set(error=e)
+                raise
+            with lock:
+                cache[key] = value
+                del pending[key]
+            call.set(value)
+            return value
 
+        if getattr(inspect, 'iscoroutinefunction', lambda fn: False)(fn):
+            # async def is a syntax error before Python 3.5
+            from ._memoize_async import async_wrapper
+            wrapper = async_wrapper(fn, cache, keymaker, debug)
+        elif thread_safe:
+            wrapper = safe_wrapper
+        elif sweeping:
+            wrapper = locked_wrapper
+        else:
+            wrapper = plain_wrapper
         wrapper.cache = cache
-        wrapper.popular = popular
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        wrapper.popular = cache.data.keys() if hasattr(cache, 'data') \
+            else None
         wrapper.limit = limit
         wrapper.func = fn
+        _registry.add(wrapper)
         return wrapper
     return decoratr
 
@@ -58,6 +1057,7 @@ if __name__ == "__main__":
         else:
             return n
     print(fibo(100))
+    print(fibo.cache_info())
 
     # Same as above, but with no limit on cache size
     @memoize()
@@ -67,3 +1067,40 @@ if __name__ == "__main__":
         else:
             return n
     print(fibonl(100))
+
+    # Key construction microbenchmark
+    from timeit import timeit
+    for args in ('1', '"some/path", 42', '"a", b=2, c=None', '[1, 2], {}'):
+        print('{0:<20} pickle_key: {1:.3f}s  make_key: {2:.3f}s'.format(
+            args, *[timeit('keymaker({0})'.format(args), number=200000,
+                           globals={'keymaker': keymaker})
+                    for keymaker in (pickle_key, make_key)]))
+
+    # Stampede benchmark: many threads miss the same key at the same time.
+    from threading import Barrier
+
+    def stampede(thread_safe, threads=32):
+        calls = []
+        barrier = Barrier(threads)
+
+        @memoize(thread_safe=thread_safe)
+        def slow(n):
+            calls.append(n)
+            time.sleep(0.1)  # an expensive query
+            return n
+
+        def worker():
+            barrier.wait()
+            slow(42)
+
+        workers = [Thread(target=worker) for i in range(threads)]
+        start = now()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        print('thread_safe={0!s:5}: {1} threads, {2} calls, {3:.3f}s'.format(
+            thread_safe, threads, len(calls), now() - start))
+
+    stampede(thread_safe=False)
+    stampede(thread_safe=True)
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for ``bag.file_existence_manager``.'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from ..file_existence_manager import find_dups, TransientStrategy
+
+
+class TestFindDups(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.write('a.jpg', b'first' * 1000)
+        self.write('b.jpg', b'second' * 1000)
+        self.write('c.jpg', b'first' * 1000)
+        self.write('d.jpg', b'first' * 1000)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as stream:
+            stream.write(content)
+        return path
+
+    def find(self, **kw):
+        found = []
+        dups = find_dups(
+            self.directory, store=TransientStrategy(),
+            callbacks=[lambda existing, dup, m: found.append(dup.name)], **kw)
+        return {os.path.basename(k): os.path.basename(v)
+                for k, v in dups.items()}, found
+
+    def test_find_dups(self):
+        dups, found = self.find()
+        assert len(dups) == 2  # the first of the 3 identical files is kept
+        assert set(dups) | set(dups.values()) == {'a.jpg', 'c.jpg', 'd.jpg'}
+        assert sorted(found) == sorted(dups)
+
+    def test_workers(self):
+        expected = self.find()
+        assert self.find(workers=3) == expected
+        assert self.find(workers=2, processes=True) == expected
+
+    def test_staged(self):
+        # Same size and same first 4096 bytes, different ending
+        self.write('e.jpg', b'x' * 5000 + b'1')
+        self.write('f.jpg', b'x' * 5000 + b'2')
+        dups, found = self.find()
+        assert len(dups) == 3  # e.jpg and f.jpg are mistaken for dups
+        expected = {k: v for k, v in dups.items() if k[0] not in 'ef'}
+        assert self.find(staged=True)[0] == expected
+        assert self.find(staged=True, workers=2)[0] == expected
+
+    def test_incremental(self):
+        from ..file_existence_manager import FileExistenceManager
+        store = TransientStrategy()
+        read = []
+        original = FileExistenceManager.hash_path
+
+        def hash_path(self, path, consider_bytes=None):
+            read.append(os.path.basename(str(path)))
+            return original(self, path, consider_bytes)
+
+        FileExistenceManager.hash_path = hash_path
+        try:
+            first = find_dups(self.directory, store=store, incremental=True)
+            assert len(first) == 2 and sorted(read) == [
+                'a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']
+            del read[:]
+            assert find_dups(self.directory, store=store,
+                             incremental=True) == first
+            assert read == []  # nothing changed, nothing was read
+            self.write('e.jpg', b'second' * 1000)
+            os.remove(os.path.join(self.directory, 'b.jpg'))
+            dups = find_dups(self.directory, store=store, incremental=True)
+            assert read == ['e.jpg']
+            assert dups == first  # b.jpg is gone, so e.jpg is unique
+            kept = os.path.basename(list(first.values())[0])
+            assert sorted(os.path.basename(v) for v in store.d.values()) \
+                == sorted([kept, 'e.jpg'])
+        finally:
+            FileExistenceManager.hash_path = original
+
+    def test_incremental_from_another_directory(self):
+        store = TransientStrategy()
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            pairs = []
+            first = find_dups('.', store=store, incremental=True,
+                              callbacks=[lambda e, d, m: pairs.append((e, d))])
+        finally:
+            os.chdir(cwd)
+        assert len(first) == 2 and len(store.stats) == 4
+        assert all(os.path.isabs(k) and os.path.isabs(v)
+                   for k, v in first.items())
+        assert all(e.is_absolute() and d.is_absolute() for e, d in pairs)
+        assert all(os.path.isabs(k.decode('utf-8')) for k in store.stats)
+        dups = find_dups(self.directory, store=store, incremental=True)
+        assert len(dups) == 2 and len(store.stats) == 4  # nothing forgotten
+        assert len(store.d) == 2
+        assert all(os.path.isabs(v) and os.path.exists(v)
+                   for v in store.d.values())
+
+    def test_sqlite_store(self):
+        from ..file_existence_manager import SqliteStorageStrategy
+        path = os.path.join(self.directory, 'hashes.sqlite')
+        expected = self.find()[0]
+        store = SqliteStorageStrategy(path, batch_size=2)
+        dups = find_dups(self.directory, store=store, incremental=True)
+        assert {os.path.basename(k): os.path.basename(v)
+                for k, v in dups.items()} == expected
+        store = SqliteStorageStrategy(path)
+        assert len(store.d) == 2
+        kept = list(dups.values())[0]
+        assert store.d[store.hash_for_path(kept)] == kept
+        assert store.hash_for_path('nonexistent') is None
+        assert find_dups(self.directory, store=store,
+                         incremental=True) == dups
+
+    def test_algorithm(self):
+        from ..file_existence_manager import (
+            FileExistenceManager, SqliteStorageStrategy)
+        expected = self.find()[0]
+        assert self.find(algorithm='blake2b', digest_size=16)[0] == expected
+        path = os.path.join(self.directory, 'hashes.sqlite')
+        store = SqliteStorageStrategy(path)
+        m = FileExistenceManager(store, algorithm='blake2b', digest_size=16)
+        assert len(m.hash_path(path)) == 16
+        m.close()
+        store = SqliteStorageStrategy(path)
+        self.assertRaises(ValueError, FileExistenceManager, store)
+
+    def test_hash_in_chunks(self):
+        from hashlib import sha1
+        from io import BytesIO
+        from ..file_existence_manager import FileExistenceManager
+        m = FileExistenceManager(TransientStrategy(), consider_bytes=0)
+        m.chunk_size = 1000
+        content = os.urandom(4500)
+        path = self.write('big.bin', content)
+        assert m.hash_path(path) == sha1(content).digest()
+        assert m._get_file_hash(BytesIO(content)) == sha1(content).digest()
+        assert m._get_file_hash(BytesIO(b'')) == sha1(b'').digest()
+
+    def test_bloom_filter(self):
+        from io import BytesIO
+        from ..file_existence_manager import (
+            FileExistenceManager, SqliteStorageStrategy)
+        path = os.path.join(self.directory, 'hashes.sqlite')
+        m = FileExistenceManager(SqliteStorageStrategy(path),
+                                 bloom_error_rate=0.001, bloom_capacity=1000)
+        for i in range(100):
+            m.try_add_file(BytesIO(str(i).encode('ascii')), str(i))
+        m.close()
+        assert os.path.exists(path + '.bloom')
+
+        m = FileExistenceManager(SqliteStorageStrategy(path),
+                                 bloom_error_rate=0.001, bloom_capacity=1000)
+        lookups = []
+        original_get = m.db.d.get
+        m.db.d.get = lambda key: lookups.append(key) or original_get(key)
+        assert m.file_exists(BytesIO(b'42')) == '42'
+        for i in range(100, 200):
+            assert m.file_exists(BytesIO(str(i).encode('ascii'))) is None
+        assert len(lookups) < 5  # new hashes did not reach the store
+        m.close()
+
+        # Another manager, without the filter, replaces an entry
+        m = FileExistenceManager(SqliteStorageStrategy(path))
+        one = m._calculate_hash(b'one')
+        m._add_or_replace_hash(one, 'one')
+        del m.db.d[one]
+        m._add_or_replace_hash(m._calculate_hash(b'two'), 'two')
+        m.close()
+
+        def open_manager():
+            return FileExistenceManager(
+                SqliteStorageStrategy(path), bloom_error_rate=0.001,
+                bloom_capacity=1000)
+        m = open_manager()
+        assert len(m.db.d) == 101  # the same number of keys as before
+        assert m.file_exists(BytesIO(b'two')) == 'two'
+
+        # A filter is not saved if someone else added keys meanwhile
+        other = FileExistenceManager(SqliteStorageStrategy(path))
+        other.try_add_file(BytesIO(b'three'), 'three')
+        other.close()
+        m.try_add_file(BytesIO(b'four'), 'four')
+        m.close()
+        m = open_manager()
+        assert m.file_exists(BytesIO(b'three')) == 'three'
+        m.close()
+
+    def test_recursive(self):
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        os.mkdir(os.path.join(self.directory, 'dups'))
+        self.write(os.path.join('sub', 'e.png'), b'second' * 1000)
+        self.write(os.path.join('dups', 'f.jpg'), b'second' * 1000)
+        assert len(self.find(files=('*.jpg', '*.png'))[0]) == 2
+        dups = self.find(files=('*.jpg', '*.png'), recursive=True,
+                         exclude=('dups', 'd.*'))[0]
+        assert len(dups) == 2 and 'e.png' in set(dups) | set(dups.values())
+
+    def test_link_duplicates(self):
+        from json import loads
+        from ..file_existence_manager import LinkDuplicates
+        self.write('e.jpg', b'first' * 1000 + b'!')  # same first 4096 bytes
+        dry = LinkDuplicates(dry_run=True)
+        find_dups(self.directory, store=TransientStrategy(), callbacks=[dry])
+        summary = loads(dry.to_json())
+        assert (summary['linked'], summary['skipped']) == (2, 1)
+        assert summary['bytes_reclaimed'] == 2 * 5000
+        assert os.stat(os.path.join(self.directory, 'a.jpg')).st_nlink == 1
+
+        for mode in ('hardlink', 'auto'):
+            linker = LinkDuplicates(mode=mode, dry_run=False)
+            find_dups(self.directory, store=TransientStrategy(),
+                      callbacks=[linker])
+            assert linker.summary['errors'] == []
+        inodes = set(os.stat(os.path.join(self.directory, name)).st_ino
+                     for name in ('a.jpg', 'c.jpg', 'd.jpg'))
+        assert len(inodes) == 1  # now the same file
+        assert linker.summary['linked'] == 0  # nothing left to do
+        self.assertRaises(ValueError, LinkDuplicates, mode='symlink')
+
+    def test_link_duplicates_without_fcntl(self):
+        import sys
+        from ..file_existence_manager import LinkDuplicates
+        a = os.path.join(self.directory, 'a.jpg')
+        c = os.path.join(self.directory, 'c.jpg')
+        fcntl = sys.modules.get('fcntl')
+        sys.modules['fcntl'] = None  # so importing it raises ImportError
+        try:
+            LinkDuplicates(mode='auto').link(a, c)  # falls back to hardlinks
+            self.assertRaises(OSError, LinkDuplicates(mode='reflink').link,
+                              a, os.path.join(self.directory, 'd.jpg'))
+        finally:
+            if fcntl is None:
+                del sys.modules['fcntl']
+            else:
+                sys.modules['fcntl'] = fcntl
+        assert os.path.samefile(a, c)
+
+    def test_dedup_index(self):
+        from ..file_existence_manager import DedupIndex, FileExistenceManager
+        found = []
+        index = DedupIndex(
+            FileExistenceManager(TransientStrategy()),
+            callbacks=[lambda existing, dup, m: found.append(dup.name)])
+        watcher = index.watch(self.directory, files='*.jpg')
+        assert len(index.dups) == 2 and len(found) == 2
+        kept = os.path.basename(list(index.dups.values())[0])
+        del found[:]
+
+        self.write('e.jpg', b'second' * 1000)  # a copy of b.jpg
+        self.write('b.jpg', b'changed' * 1000)  # no longer a copy
+        watcher.iterate()
+        assert found == []  # b.jpg changed, so e.jpg is unique
+        self.write('f.jpg', b'changed' * 1000)
+        watcher.iterate()
+        assert found == ['f.jpg']
+        f = os.path.join(self.directory, 'f.jpg')
+        assert index.dups[f] == os.path.join(self.directory, 'b.jpg')
+
+        os.remove(os.path.join(self.directory, kept))
+        watcher.iterate()  # a copy of the deleted file takes its place
+        values = set(os.path.basename(v) for v in index.dups.values())
+        assert kept not in values and len(index.dups) == 2
+        stored = sorted(os.path.basename(v)
+                        for v in index.manager.db.d.values())
+        assert len(stored) == 3 and kept not in stored
+
+
+class FakeGdbm(dict):
+    '''Stands for a dbm.gnu database, which is not always available.
+        Like gdbm, it stores str keys and values as UTF-8 bytes. The data
+        of each path survives reopening, as if it were in a file.
+        '''
+    files = {}
+
+    @staticmethod
+    def _bytes(value):
+        return value.encode('utf-8') if isinstance(value, str) else value
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, self._bytes(key))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, self._bytes(key), self._bytes(value))
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, self._bytes(key))
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self._bytes(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, self._bytes(key), default)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    @classmethod
+    def open(cls, path, flag='r'):
+        if flag[0] == 'n' or path not in cls.files:
+            cls.files[path] = cls()
+        return cls.files[path]
+
+
+class TestGdbmStorageStrategy(unittest.TestCase):
+    def setUp(self):
+        import sys
+        import types
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'hashes.gdbm')
+        self.real = sys.modules.get('dbm.gnu')
+        module = types.ModuleType(str('dbm.gnu'))
+        module.open = FakeGdbm.open
+        sys.modules['dbm.gnu'] = module
+        for name, content in (('a.jpg', b'first'), ('b.jpg', b'second'),
+                              ('c.jpg', b'first')):
+            with open(os.path.join(self.directory, name), 'wb') as stream:
+                stream.write(content * 1000)
+
+    def tearDown(self):
+        import sys
+        if self.real is None:
+            del sys.modules['dbm.gnu']
+        else:
+            sys.modules['dbm.gnu'] = self.real
+        FakeGdbm.files.clear()
+        rmtree(self.directory)
+
+    def store(self, **kw):
+        from ..file_existence_manager import GdbmStorageStrategy
+        return GdbmStorageStrategy(self.path, **kw)
+
+    def read(self, suffix):
+        with open(self.path + suffix) as stream:
+            return stream.read()
+
+    def test_stats(self):
+        from ..file_existence_manager import FileExistenceManager
+        dups = find_dups(self.directory, files='*.jpg',
+                         store=self.store(incremental=True), incremental=True)
+        assert len(dups) == 1
+        stats = FakeGdbm.files[self.path + '.stats']
+        assert len(stats) == 3
+        m = FileExistenceManager(self.store(incremental=True))
+        c = os.path.join(self.directory, 'c.jpg')
+        assert m.known_hash(c) == m.hash_path(c)
+        os.remove(c)
+        m.close()
+        assert find_dups(self.directory, files='*.jpg',
+                         store=self.store(incremental=True),
+                         incremental=True) == {}
+        assert len(stats) == 2  # c.jpg was forgotten
+
+    def test_algorithm(self):
+        from ..file_existence_manager import FileExistenceManager
+        FileExistenceManager(self.store(), algorithm='blake2b',
+                             digest_size=16).close()
+        assert self.read('.algorithm') == 'blake2b-16'
+        assert self.store().algorithm == 'blake2b-16'
+        assert len(FakeGdbm.files[self.path]) == 0  # not among the hashes
+        self.assertRaises(ValueError, FileExistenceManager, self.store())
+
+    def test_legacy_algorithm_record(self):
+        from ..file_existence_manager import GdbmStorageStrategy
+        d = FakeGdbm.open(self.path, 'c')
+        d[GdbmStorageStrategy.legacy_algorithm_key] = b'md5'
+        d[b'somehash'] = b'/some/path'
+        assert self.store(mode='r').algorithm == 'md5'  # not migrated
+        assert GdbmStorageStrategy.legacy_algorithm_key in d
+        store = self.store()
+        assert store.algorithm == 'md5' and self.read('.algorithm') == 'md5'
+        assert list(d.keys()) == [b'somehash']
+
+    def test_generation(self):
+        from io import BytesIO
+        from ..file_existence_manager import FileExistenceManager
+        store = self.store()
+        assert store.generation == 0
+        m = FileExistenceManager(store)
+        m.try_add_file(BytesIO(b'one'), 'one')
+        assert self.read('.generation') == '1'  # saved on the first key
+        m.try_add_file(BytesIO(b'two'), 'two')
+        m.try_add_file(BytesIO(b'one'), 'another one')  # not added
+        m.close()
+        assert self.read('.generation') == '2'
+        assert self.store().generation == 2
+
+        # A saved Bloom filter is stale once another manager adds keys
+        def open_manager():
+            return FileExistenceManager(self.store(), bloom_error_rate=0.001,
+                                        bloom_capacity=1000)
+        open_manager().close()
+        assert os.path.exists(self.path + '.bloom')
+        other = FileExistenceManager(self.store())
+        other.try_add_file(BytesIO(b'three'), 'three')
+        other.close()
+        m = open_manager()
+        assert m.file_exists(BytesIO(b'three')) == b'three'  # gdbm bytes
+        m.close()
+
+
+class TestBKTree(unittest.TestCase):
+    def test_search(self):
+        from random import Random
+        from ..file_existence_manager import BKTree, hamming_distance
+        random = Random(42)
+        hashes = [random.getrandbits(64) for i in range(500)]
+        tree = BKTree()
+        for i, h in enumerate(hashes):
+            tree.add(h, i)
+        query = hashes[7] ^ 0b101  # 2 bits away from hashes[7]
+        found = tree.search(query, 10)
+        assert found[0] == (2, 7)
+        assert found == sorted(
+            (hamming_distance(query, h), i) for i, h in enumerate(hashes)
+            if hamming_distance(query, h) <= 10)
+
+    def test_find_similar_images(self):
+        from ..file_existence_manager import find_similar_images
+        directory = mkdtemp()
+        try:
+            for name, content in (('a.jpg', b'1111'), ('b.jpg', b'1110'),
+                                  ('c.jpg', b'0000'), ('d.jpg', b'bad!')):
+                with open(os.path.join(directory, name), 'wb') as stream:
+                    stream.write(content)
+
+            def fake_hash(path):
+                with open(str(path), 'rb') as stream:
+                    return int(stream.read(), 2)  # ValueError for d.jpg
+
+            dups = find_similar_images(directory, max_distance=1,
+                                       hash_function=fake_hash)
+            assert {os.path.basename(k): os.path.basename(v)
+                    for k, v in dups.items()} in (
+                {'b.jpg': 'a.jpg'}, {'a.jpg': 'b.jpg'})
+        finally:
+            rmtree(directory)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for ``bag.file_id_manager``.'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import unittest
+import warnings
+from io import BytesIO
+from shutil import rmtree
+from tempfile import mkdtemp
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    from ..file_id_manager import FileIdManager
+
+
+class TestFileIdManager(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.path = os.path.join(self.directory, 'ids.bin')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_process(self):
+        m = FileIdManager(self.path)
+        assert m.process(BytesIO(b'first')) is False
+        assert m.process(BytesIO(b'second')) is False
+        assert m.process(BytesIO(b'first')) is True
+        m.close()
+        assert os.path.getsize(self.path) == 2 * FileIdManager.recordlength
+        m = FileIdManager(self.path)  # IDs are read back from the file
+        assert m.process(BytesIO(b'second')) is True
+        assert m.process(BytesIO(b'third')) is False
+        assert m.is_id_known(m.get_id_for(BytesIO(b'third')))
+        m.close()
+
+    def test_algorithm(self):
+        m = FileIdManager(self.path, algorithm='blake2b', digest_size=20)
+        m.process(BytesIO(b'first'))
+        m.close()
+        with open(self.path + '.algorithm') as stream:
+            assert stream.read() == 'blake2b-20'
+        m = FileIdManager(self.path, algorithm='blake2b', digest_size=20)
+        assert m.process(BytesIO(b'first')) is True
+        m.close()
+        self.assertRaises(ValueError, FileIdManager, self.path)  # sha1
+        self.assertRaises(ValueError, FileIdManager, self.path,
+                          algorithm='sha256')  # not 20 bytes
+
+    def test_old_files_are_sha1(self):
+        with open(self.path, 'wb') as stream:
+            stream.write(b'\0' * FileIdManager.recordlength)
+        self.assertRaises(ValueError, FileIdManager, self.path,
+                          algorithm='blake2b', digest_size=20)
+        FileIdManager(self.path).close()
+        assert not os.path.exists(self.path + '.algorithm')
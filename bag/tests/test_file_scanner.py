@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for ``bag.file_scanner``.'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from ..file_scanner import scan_files
+
+
+class TestScanFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'sub'))
+        for name in ('a.jpg', 'b.txt', os.path.join('sub', 'c.jpg')):
+            with open(os.path.join(self.directory, name), 'wb') as stream:
+                stream.write(b'x' * 10)
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_scan_files(self):
+        found = {path.name: stat for path, stat in scan_files(
+            self.directory, include='*.jpg')}
+        assert sorted(found) == ['a.jpg', 'c.jpg']
+        assert found['a.jpg'].st_size == 10
+        assert [path.name for path, stat in scan_files(
+            self.directory, include='*.jpg', recursive=False)] == ['a.jpg']
+        assert [path.name for path, stat in scan_files(
+            self.directory, exclude=('sub', '*.txt'))] == ['a.jpg']
+
+    def test_path_patterns(self):
+        def names(include, **kw):
+            return sorted(path.name for path, stat in scan_files(
+                self.directory, include=include, **kw))
+        assert names('**/*.jpg', recursive=False) == ['a.jpg', 'c.jpg']
+        assert names('sub/*.jpg') == ['c.jpg']
+        assert names(('*.jpg', 'sub/*.jpg')) == ['a.jpg', 'c.jpg']
+        assert names('**/*.jpg', exclude='sub') == ['a.jpg']
+        path, stat = next(scan_files(self.directory, 'sub/*.jpg'))
+        assert stat.st_size == 10
+
+    def test_stat_is_lazy(self):
+        from ..file_scanner import LazyStat
+        calls = []
+
+        class Entry(object):
+            def stat(self):
+                calls.append(1)
+                return os.stat(__file__)
+
+        stat = LazyStat(Entry())
+        assert calls == []
+        assert stat.st_size == os.stat(__file__).st_size and calls == [1]
+        assert all(isinstance(stat, LazyStat)
+                   for path, stat in scan_files(self.directory))
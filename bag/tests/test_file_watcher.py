@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for ``bag.file_watcher``.'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import errno
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from ..file_watcher import AsyncFileWatcher, DirectoryWatcher, FileWatcher
+
+
+class TestDirectoryWatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.changed = []
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write(self, name, content=b'content'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as stream:
+            stream.write(content)
+        return path
+
+    def test_directory_watcher(self):
+        a = self.write('a.txt')
+        watcher = DirectoryWatcher(self.directory, self.changed.append,
+                                   files='*.txt', backend='poll')
+        assert watcher.inotify is None
+        watcher.iterate()
+        assert self.changed == []
+        b = self.write('b.txt')
+        self.write('c.log')
+        watcher.iterate()
+        assert self.changed == [b]
+        self.write('a.txt', b'longer content')
+        os.remove(b)
+        watcher.iterate()
+        assert sorted(self.changed) == sorted([b, a, b])
+
+    def test_initial(self):
+        a = self.write('a.txt')
+        watcher = DirectoryWatcher([self.directory], self.changed.append,
+                                   initial=True)
+        watcher.iterate()
+        watcher.iterate()
+        assert self.changed == [a]
+        watcher.close()
+        self.assertRaises(ValueError, DirectoryWatcher, self.directory,
+                          self.changed.append, backend='fsevents')
+
+    def test_inotify(self):
+        a = self.write('a.txt')
+        try:
+            watcher = DirectoryWatcher(self.directory, self.changed.append,
+                                       files='*.txt', backend='inotify')
+        except OSError:
+            raise unittest.SkipTest('inotify is not available')
+        try:
+            watcher.iterate()
+            assert self.changed == []
+            sub = os.path.join(self.directory, 'sub')
+            os.mkdir(sub)
+            b = self.write(os.path.join('sub', 'b.txt'))
+            self.write('c.log')
+            watcher.iterate()
+            assert self.changed == [b]  # in a directory made after start
+            self.write('a.txt', b'longer content')
+            self.write(os.path.join('sub', 'b.txt'), b'again')
+            self.write(os.path.join('sub', 'b.txt'), b'and again')
+            watcher.iterate()
+            assert self.changed == [b, a, b]  # reported once per check
+            moved = os.path.join(self.directory, 'moved')
+            os.rename(sub, moved)
+            watcher.iterate()
+            assert self.changed[3:] == [
+                b, os.path.join(moved, 'b.txt')]
+            rmtree(moved)
+            os.remove(a)
+            watcher.iterate()
+            assert sorted(self.changed[5:]) == sorted(
+                [a, os.path.join(moved, 'b.txt')])
+            assert watcher.snapshot == {}
+        finally:
+            watcher.close()
+
+    def test_fallback_in_loop(self):
+        a = self.write('a.txt')
+        try:
+            watcher = DirectoryWatcher(self.directory, self.changed.append,
+                                       seconds=0.01, backend='inotify')
+        except OSError:
+            raise unittest.SkipTest('inotify is not available')
+
+        def out_of_watches():
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        watcher._read_events = out_of_watches
+
+        def callback(path):
+            self.changed.append(path)
+            watcher.stop = True
+        watcher.callback = callback
+        watcher.loop()  # polls after inotify fails
+        assert watcher.inotify is None and self.changed == [a]
+
+
+class TestFileWatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.changed = []
+        self.a = os.path.join(self.directory, 'a.txt')
+        self.b = os.path.join(self.directory, 'b.txt')
+        for path in (self.a, self.b):
+            with open(path, 'w') as stream:
+                stream.write('content')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_poll(self):
+        watcher = FileWatcher([self.a, self.b, ''], self.changed.append,
+                              backend='poll')
+        assert watcher.inotify is None
+        watcher.iterate()
+        os.utime(self.a, (0, 1e10))
+        watcher.iterate()
+        assert self.changed == [self.a]
+
+    def test_scandir(self):
+        watcher = FileWatcher([self.a, self.b], self.changed.append,
+                              backend='scandir', rescan=3, max_seconds=5)
+        watcher.iterate()
+        os.utime(self.a, (0, 1e10))  # the directory does not change...
+        watcher.iterate()
+        assert self.changed == [] and watcher.pause_duration > 1.3
+        watcher.iterate()  # ...until every 3rd check lists it anyway
+        assert self.changed == [self.a] and watcher.pause_duration == 1.3
+        os.remove(self.b)
+        watcher.iterate()
+        assert self.changed == [self.a, self.b]
+        for i in range(5):
+            watcher.iterate()
+        assert watcher.pause_duration == 5
+
+    def test_debounce(self):
+        watcher = FileWatcher([self.a, self.b], self.changed.append,
+                              backend='poll', debounce=60, max_delay=300)
+        watcher.iterate()
+        os.utime(self.a, (0, 1e10))
+        os.utime(self.b, (0, 1e10))
+        watcher.iterate()
+        assert self.changed == [] and 59 < watcher._due() <= 60
+        watcher.last_change -= 60  # as if nothing changed for a minute
+        watcher.iterate()
+        assert self.changed == [{self.a, self.b}]
+
+        os.utime(self.a, (0, 2e10))
+        watcher.iterate()
+        watcher.first_change -= 300  # changes kept coming for 5 minutes
+        watcher.iterate()
+        assert self.changed[1:] == [{self.a}]
+
+    def test_inotify(self):
+        try:
+            watcher = FileWatcher([self.a], self.changed.append,
+                                  backend='inotify')
+        except OSError:
+            raise unittest.SkipTest('inotify is not available')
+        try:
+            watcher.iterate()
+            assert self.changed == []
+            with open(self.b, 'w') as stream:  # not watched
+                stream.write('changed')
+            temporary = self.a + '.tmp'
+            with open(temporary, 'w') as stream:
+                stream.write('changed')
+            os.rename(temporary, self.a)  # the way editors save
+            with open(self.a, 'a') as stream:
+                stream.write('!')
+            watcher.iterate()
+            assert self.changed == [self.a]  # reported once
+            os.remove(self.a)
+            watcher.iterate()
+            assert self.changed == [self.a, self.a]
+        finally:
+            watcher.close()
+
+    def test_python2_fallbacks(self):
+        import subprocess
+        import sys
+        if not sys.platform.startswith('linux'):
+            raise unittest.SkipTest('inotify is only available on Linux')
+        # In another interpreter, so this one keeps its modules intact
+        script = '''if True:
+            import os, time
+            import bag.file_scanner, threading  # need the originals
+            originals = time.monotonic, os.fsencode, os.fsdecode
+            del time.monotonic, os.fsencode, os.fsdecode  # as on Python 2
+            from bag.file_watcher import (
+                FileWatcher, fsdecode, fsencode, monotonic)
+            time.monotonic, os.fsencode, os.fsdecode = originals  # stdlib
+            assert monotonic is time.time
+            assert fsdecode(fsencode('a.txt')) == 'a.txt'
+            changed = []
+            watcher = FileWatcher([{0!r}], changed.append,
+                                  backend='inotify')
+            with open({0!r}, 'a') as stream:
+                stream.write('!')
+            watcher.iterate()
+            assert changed == [{0!r}]
+            '''.format(self.a)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        subprocess.check_call([sys.executable, '-c', script], cwd=root)
+
+    def test_inotify_symlink(self):
+        target = os.path.join(mkdtemp(), 'target.txt')
+        with open(target, 'w') as stream:
+            stream.write('content')
+        link = os.path.join(self.directory, 'link.txt')
+        os.symlink(target, link)
+        try:
+            watcher = FileWatcher([link, self.a], self.changed.append,
+                                  backend='inotify')
+        except OSError:
+            raise unittest.SkipTest('inotify is not available')
+        try:
+            with open(target, 'a') as stream:  # not through the link
+                stream.write('!')
+            watcher.iterate()
+            assert self.changed == [link]
+        finally:
+            watcher.close()
+            rmtree(os.path.dirname(target))
+
+
+class TestAsyncFileWatcher(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.a = os.path.join(self.directory, 'a.txt')
+        self.b = os.path.join(self.directory, 'b.txt')
+        for path in (self.a, self.b):
+            with open(path, 'w') as stream:
+                stream.write('content')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def watch(self, **kw):
+        import asyncio
+        watcher = AsyncFileWatcher([self.a, self.b], **kw)
+        changed = []
+
+        def change():
+            os.utime(self.a, (0, 1e10))
+            os.utime(self.b, (0, 1e10))
+
+        async def consume():
+            async for change in watcher:
+                changed.append(change)
+                if len(changed) == 2 or kw.get('debounce'):
+                    watcher.close()
+
+        async def main():
+            task = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.05)
+            change()
+            await asyncio.wait_for(task, 5)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(main())
+        finally:
+            loop.close()
+        return watcher, changed
+
+    def test_poll(self):
+        watcher, changed = self.watch(backend='poll', seconds=0.01)
+        assert sorted(changed) == sorted([self.a, self.b])
+
+    def test_inotify(self):
+        try:
+            watcher, changed = self.watch(backend='inotify', debounce=0.05)
+        except OSError:
+            raise unittest.SkipTest('inotify is not available')
+        assert changed == [{self.a, self.b}]
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+'''Tests for ``bag.memoize``.'''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+import sys
+import unittest
+from time import time
+from ..memoize import memoize
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+class TestMemoize(unittest.TestCase):
+    def test_lru_eviction_and_cache_info(self):
+        calls = []
+
+        @memoize(2)
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        assert double(1) == 2
+        assert double(2) == 4
+        assert double(1) == 2  # hit; 2 becomes the least recently used
+        assert double(3) == 6  # evicts 2
+        assert double(1) == 2  # still cached
+        assert double(2) == 4  # computed again
+        assert calls == [1, 2, 3, 2]
+        info = double.cache_info()
+        assert (info.hits, info.misses, info.evictions, info.size) == \
+            (2, 4, 2, 2)
+        double.cache_clear()
+        assert double.cache_info().size == 0
+
+    def test_mapping_cache_type(self):
+        from weakref import WeakValueDictionary
+
+        class Value(object):
+            pass
+
+        @memoize(2, cache_type=dict)
+        def double(n):
+            return n * 2
+
+        assert [double(n) for n in (1, 2, 1, 3)] == [2, 4, 2, 6]
+        assert list(double.popular) == [1, 3]
+        assert double.cache_info().evictions == 1
+
+        @memoize(cache_type=WeakValueDictionary)
+        def make(n):
+            return Value()
+
+        kept = make(1)
+        assert make(1) is kept
+        make(2)  # nothing else refers to this value, so it goes away
+        assert 2 not in make.cache and len(make.cache) == 1
+        self.assertRaises(TypeError, memoize(cache_type=dict, ttl=1), make)
+
+    def test_ttl(self):
+        from .. import memoize as module
+        clock = [1000.0]
+        original_now = module.now
+        module.now = lambda: clock[0]
+        try:
+            calls = []
+
+            @memoize(ttl=10)
+            def double(n):
+                calls.append(n)
+                return n * 2
+
+            assert double(1) == 2
+            assert double(2) == 4
+            clock[0] += 5
+            assert double(1) == 2  # still fresh
+            assert double(3) == 6
+            clock[0] += 5  # 1 and 2 are now 10 seconds old
+            assert double(1) == 2  # recomputed
+            assert calls == [1, 2, 3, 1]
+            assert double.cache.sweep() == 1  # discards 2
+            assert double.cache_info().size == 2
+            assert double.cache_info().expirations == 2
+        finally:
+            module.now = original_now
+
+    def test_sweeper_shares_the_lock(self):
+        @memoize(limit=50, ttl=0.002, sweep_interval=0.001, max_bytes=10000)
+        def text(n):
+            return 'x' * n
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)  # switch threads as often as possible
+        try:
+            deadline = time() + 0.3
+            i = 0
+            while time() < deadline:  # races with the sweeper thread
+                i += 1
+                assert text(i % 80) == 'x' * (i % 80)
+        finally:
+            sys.setswitchinterval(interval)
+        cache = text.cache
+        with cache.lock:
+            assert cache.total_bytes == sum(cache.sizes.values())
+            assert set(cache.sizes) == set(cache.data)
+
+    def test_thread_safe_single_flight(self):
+        from threading import Event, Thread
+        calls = []
+        release = Event()
+
+        @memoize(thread_safe=True)
+        def slow(n):
+            calls.append(n)
+            release.wait()
+            return n * 2
+
+        results = []
+        threads = [Thread(target=lambda: results.append(slow(5)))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        while not calls:
+            pass  # wait for the first thread to start computing
+        release.set()
+        for t in threads:
+            t.join()
+        assert calls == [5]
+        assert results == [10] * 8
+
+    def test_thread_safe_propagates_errors(self):
+        @memoize(thread_safe=True)
+        def fail(n):
+            raise ValueError(n)
+
+        self.assertRaises(ValueError, fail, 1)
+        self.assertRaises(ValueError, fail, 1)  # errors are not cached
+        assert fail.cache_info().size == 0
+
+    def test_make_key(self):
+        from ..memoize import make_key, pickle_key
+        assert make_key(1, a=2, b=3) == make_key(1, b=3, a=2)
+        assert make_key(1, 2) != make_key(1, b=2)
+        assert make_key((1,)) != make_key(1)
+        assert make_key(1, 'a') == make_key(1.0, 'a') == make_key(True, 'a')
+        assert make_key(1) != make_key(1.0)  # the fast path for one int
+        hash(make_key('x', [1, 2], {'a': 1}))
+        assert make_key([1, 2]) == pickle_key([1, 2])
+
+        @memoize()
+        def total(seq, start=0):
+            return sum(seq, start)
+
+        assert total([1, 2]) == 3
+        assert total([1, 2], start=1) == 4
+        assert total([1, 2]) == 3
+        assert total.cache_info().hits == 1
+
+    def test_coroutine_function(self):
+        import asyncio
+        calls = []
+
+        @memoize(2)
+        async def fetch(n):
+            calls.append(n)
+            await asyncio.sleep(0.01)
+            if n < 0:
+                raise ValueError(n)
+            return n * 2
+
+        async def main():
+            assert await asyncio.gather(fetch(1), fetch(1), fetch(2)) == \
+                [2, 2, 4]
+            assert await fetch(1) == 2
+            assert await fetch(1) == 2
+            for i in range(2):
+                try:
+                    await fetch(-1)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError('ValueError expected')
+
+        asyncio.run(main())
+        assert calls == [1, 2, -1, -1]
+        assert fetch.cache_info().size == 2
+
+        # Another event loop, in another thread, while a task is in flight
+        from threading import Thread
+        results = []
+
+        async def other():
+            results.append(await fetch(3))
+
+        async def first():
+            task = asyncio.ensure_future(fetch(3))
+            await asyncio.sleep(0)
+            thread = Thread(target=lambda: asyncio.run(other()))
+            thread.start()
+            results.append(await task)
+            thread.join()
+
+        asyncio.run(first())
+        assert results == [6, 6]
+
+        # The memoized function is a coroutine function itself
+        import inspect
+        assert inspect.iscoroutinefunction(fetch)
+        assert asyncio.run(fetch(4)) == 8
+        assert asyncio.run(fetch(4)) == 8  # a hit, outside of any loop
+        assert calls.count(4) == 1
+
+    def test_max_bytes(self):
+        @memoize(max_bytes=100, sizeof=len)
+        def fragment(name, size):
+            return name * size
+
+        fragment('a', 40)
+        fragment('b', 40)
+        assert fragment.cache_info().bytes == 80
+        fragment('a', 40)  # now b is the least recently used
+        fragment('c', 30)  # evicts b
+        info = fragment.cache_info()
+        assert (info.size, info.bytes, info.evictions) == (2, 70, 1)
+        assert ('b', 40) not in fragment.cache
+        fragment('d', 500)  # too large to be kept at all
+        assert fragment.cache_info().bytes <= 100
+
+    def test_sqlite_tier(self):
+        import os
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from ..memoize import SqliteTier
+        directory = mkdtemp()
+        path = os.path.join(directory, 'memoize.sqlite')
+        calls = []
+
+        def double(n, times=2):
+            calls.append(n)
+            return n * times
+
+        try:
+            tier = SqliteTier(path)
+            first = memoize(tier=tier)(double)
+            assert first(1) == 2
+            assert first(2, times=3) == 6
+            tier.close()
+
+            tier = SqliteTier(path)  # as if the process had restarted
+            second = memoize(tier=tier)(double)
+            assert second(1) == 2
+            assert calls == [1, 2]
+            third = memoize(tier=tier, warm=True)(double)
+            assert third.cache_info().size == 2
+            assert third(2, times=3) == 6
+            assert calls == [1, 2]
+            third.cache_clear()
+            assert tier.items(third.cache.namespace) == []
+            tier.close()
+        finally:
+            rmtree(directory)
+
+    def test_sqlite_tier_unpickling_error(self):
+        import os
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from ..memoize import SqliteTier, make_key
+        directory = mkdtemp()
+        path = os.path.join(directory, 'memoize.sqlite')
+        module = sys.modules[__name__]
+        point = module.Point
+
+        def load(n):
+            return Point(n, n)
+
+        try:
+            tier = SqliteTier(path)
+            first = memoize(tier=tier)(load)
+            assert first(1).x == 1 and first(2).x == 2
+            namespace = first.cache.namespace
+            tier.close()
+            del module.Point  # as if a deploy had renamed the class
+            try:
+                tier = SqliteTier(path)
+                assert tier.get(namespace, make_key(1)) is None
+                cold = memoize(tier=tier, warm=True)(load)
+                assert cold.cache_info().size == 0
+                assert tier.items(namespace) == []  # the rows are gone
+                tier.close()
+            finally:
+                module.Point = point
+            tier = SqliteTier(path)
+            assert memoize(tier=tier)(load)(1).x == 1  # computed again
+            tier.close()
+        finally:
+            rmtree(directory)
+
+    def test_shared_memory_cache(self):
+        import os
+        from functools import partial
+        from shutil import rmtree
+        from tempfile import mkdtemp
+        from ..memoize import SharedMemoryCache
+        directory = mkdtemp()
+        calls = []
+
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        try:
+            engine = partial(SharedMemoryCache, directory=directory,
+                             slot_size=256)
+            first = memoize(16, cache_type=engine)(double)
+            second = memoize(16, cache_type=engine)(double)  # same file
+            assert first(1) == 2
+            assert second(1) == 2
+            assert calls == [1]
+            if hasattr(os, 'fork'):
+                pid = os.fork()
+                if pid == 0:  # the child process computes a value
+                    first(2)
+                    os._exit(0)
+                os.waitpid(pid, 0)
+                assert second(2) == 4
+                assert calls == [1]
+            assert first(['x' * 300]) == ['x' * 300] * 2  # too large
+            for n in range(100):
+                first(n)
+            assert len(first.cache) == 16
+            first.cache_clear()
+            assert len(second.cache) == 0
+
+            # Another size is another file; the one in use is untouched.
+            third = memoize(32, cache_type=engine)(double)
+            assert third.cache.path != first.cache.path
+            first(5)
+            assert first.cache.path in [os.path.join(directory, name)
+                                        for name in os.listdir(directory)]
+            self.assertRaises(ValueError, SharedMemoryCache, 32,
+                              path=first.cache.path, slot_size=256)
+            self.assertRaises(TypeError, SharedMemoryCache, 16)
+            # One process shares one descriptor and one thread lock
+            assert first.cache.fd == second.cache.fd
+            assert first.cache._local_lock is second.cache._local_lock
+            first.cache.close()
+            assert second(1) == 2  # still open, and still locking
+            second.cache.close()
+            third.cache.remove()
+            assert not os.path.exists(third.cache.path)
+        finally:
+            rmtree(directory)
+
+    def test_registry(self):
+        from ..memoize import cache_report, clear_caches
+
+        @memoize()
+        def small(n):
+            return n
+
+        @memoize()
+        def large(n):
+            return 'x' * 10000
+
+        small(1)
+        small(1)
+        large(1)
+        names = [adict['function'] for adict in cache_report()]
+        assert names.index(large.cache.namespace) < \
+            names.index(small.cache.namespace)
+        adict = [adict for adict in cache_report()
+                 if adict['function'] == small.cache.namespace][0]
+        assert (adict['size'], adict['hit_ratio']) == (1, 0.5)
+        assert clear_caches(small.cache.namespace) == 1
+        assert small.cache_info().size == 0
+        assert large.cache_info().size == 1
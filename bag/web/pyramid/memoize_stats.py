@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+'''A Pyramid view that serves, as JSON, the statistics of every function
+    decorated with ``bag.memoize.memoize``: entries, approximate bytes,
+    hits, misses, hit ratio and evictions. Largest caches come first.
+    Usage::
+
+        config.include('bag.web.pyramid.memoize_stats')
+
+    The URL is ``/_memoize_stats`` unless you change the setting
+    ``bag.memoize_stats.path``. The statistics reveal the names of
+    internal functions, so the view is protected by the permission named
+    in the setting ``bag.memoize_stats.permission``. Without that setting,
+    everyone is denied access.
+    '''
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from pyramid.httpexceptions import HTTPForbidden
+from bag.memoize import cache_report
+
+
+def memoize_stats_view(context, request):
+    return cache_report()
+
+
+def forbidden_view(context, request):
+    raise HTTPForbidden('Memoize statistics are disabled until the '
+                        'bag.memoize_stats.permission setting is configured.')
+
+
+def includeme(config):
+    settings = config.get_settings()
+    permission = settings.get('bag.memoize_stats.permission')
+    config.add_route('memoize_stats', settings.get(
+        'bag.memoize_stats.path', '/_memoize_stats'))
+    if permission:
+        config.add_view(
+            memoize_stats_view, route_name='memoize_stats', renderer='json',
+            permission=permission)
+    else:
+        config.add_view(forbidden_view, route_name='memoize_stats')
@@ -13,6 +13,8 @@ dependencies = ['nine>=0.3.4', 'polib', 'argh']
 from sys import version_info
 if version_info[:2] < (3, 4):
     dependencies.append('pathlib')
+if version_info[:2] < (3, 5):
+    dependencies.append('scandir')
 if version_info[:2] == (2, 6):
     dependencies.append('ordereddict')
 